@@ -1,10 +1,20 @@
+import concurrent.futures
 import ctypes
 import enum
-from math import log2
+import threading
+from math import ceil, log2
 
 
 class EncoderException(Exception):
-    """Raise when an exception happens relating to the Adlink encoder card."""
+    """Raise when an exception happens relating to the Adlink encoder card. code is the card's error code, if any."""
+
+    def __init__(self, message='', code=None):
+        super().__init__(message)
+        self.code = code
+
+
+class OvershootError(EncoderException):
+    """Raise when the encoder has gone past the position being waited for without generating a trigger event."""
 
 
 # function to check for valid return codes
@@ -25,11 +35,14 @@ err_codes = {-10000: "Card number", -10001: "operation system version", -10002:
 
 def CheckSuccess(result, func, arguments):
     if not result == 0:
-        raise EncoderException(f'function {func.__name__} failed with error code {result} "{err_codes[result]}"')
+        raise EncoderException(f'function {func.__name__} failed with error code {result} "{err_codes[result]}"', result)
     else:
         return result
 
 
+wait_timed_out = -10220  # "axis INT wait failed"
+
+
 class InterruptFactor(enum.IntFlag):
     """Enumeration of interrupt factors used by set_motion_int_factor."""
     NORMAL_STOP = enum.auto()
@@ -77,6 +90,7 @@ class Axis:
         self.dll = dll
         self.id = axis_id
         self.card_id = card_id
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='encoder-wait')
         self.setInterruptFactor(InterruptFactor.WHEN_TRIGGER_COMPARATOR_CONDITIONS_ARE_MET)
 
     def setPosition(self, position):
@@ -108,13 +122,64 @@ class Axis:
         self.setTriggerPosition(ComparingSource.FEEDBACK_COUNTER, method, position)
         self.waitForInterrupt(log2(InterruptFactor.WHEN_TRIGGER_COMPARATOR_CONDITIONS_ARE_MET), timeout)
 
-
-class AdlinkCard:
-    """Class to handle communications with the ADLINK encoder reader card. This allows us to get encoder output
-    and use it to trigger Hall probe readings when the encoder passes given values."""
-
-    def __init__(self):
-        dll = ctypes.WinDLL(r'C:\Program Files\ADLINK\PCI-8102\Library\8102.dll')
+    def waitForPositionAsync(self, position, timeout=10000, on_overshoot=None, slice_timeout=20, grace=0.05):
+        """Wait for the encoder to reach a given position in the axis's worker thread, and return a Future.
+        The thread waits for the trigger event in slices of slice_timeout ms (the DLL call releases the GIL), so only
+        one call is in the DLL for the axis at a time. In between, it stops if the Future has been cancelled, and checks
+        the position: if the encoder has been past it for more than grace seconds' worth of slices, the trigger event
+        has been missed, so on_overshoot() is called (e.g. to stop the axis) and the Future raises OvershootError.
+        Timeout in milliseconds.
+        N.B. this assumes that an event raised between slices is kept by the driver until the next wait."""
+        direction = -1 if position < self.getPosition() else 1
+        method = CompareMethod.DATA_GT_SOURCE_COUNTER if direction < 0 else CompareMethod.DATA_LT_SOURCE_COUNTER
+        self.setTriggerPosition(ComparingSource.FEEDBACK_COUNTER, method, position)
+        future = concurrent.futures.Future()  # left pending while waiting, so that it can still be cancelled
+        cancelled = threading.Event()
+        future.add_done_callback(lambda f: cancelled.set())
+
+        def finish(exception=None):
+            try:
+                if exception is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(exception)
+            except concurrent.futures.InvalidStateError:  # cancelled meanwhile
+                pass
+
+        def wait():
+            # count slices rather than reading the clock, so that a replayed log makes the same decisions
+            slices_left = max(1, ceil(timeout / slice_timeout))
+            slices_past = 0
+            while not cancelled.is_set():
+                try:
+                    self.waitForInterrupt(log2(InterruptFactor.WHEN_TRIGGER_COMPARATOR_CONDITIONS_ARE_MET),
+                                          min(slice_timeout, timeout))
+                    finish()
+                    return
+                except EncoderException as e:
+                    slices_left -= 1
+                    if e.code != wait_timed_out or slices_left <= 0:
+                        finish(e)
+                        return
+                now = self.getPosition()
+                if (now - position) * direction < 0:
+                    continue
+                slices_past += 1
+                if slices_past * slice_timeout > grace * 1000:
+                    if on_overshoot is not None:
+                        on_overshoot()
+                    finish(OvershootError(f'Missed trigger at {position}, already at {now}'))
+                    return
+
+        self.executor.submit(wait)
+        return future
+
+
+class DllBackend:
+    """Calls into the ADLINK 8102 DLL using ctypes. Any object with the same _8102_* functions can be used instead."""
+
+    def __init__(self, path=r'C:\Program Files\ADLINK\PCI-8102\Library\8102.dll'):
+        dll = ctypes.WinDLL(path)
         # set up return and argument types for functions we're interested in
         funcs = {'initial': [ctypes.POINTER(ctypes.c_uint16), ctypes.c_int16],
                  'config_from_file': None,
@@ -130,7 +195,20 @@ class AdlinkCard:
             func.restype = ctypes.c_int16
             func.argtypes = arg_types
             func.errcheck = CheckSuccess
+        self.dll = dll
+
+    def __getattr__(self, name):
+        return getattr(self.dll, name)
+
 
+class AdlinkCard:
+    """Class to handle communications with the ADLINK encoder reader card. This allows us to get encoder output
+    and use it to trigger Hall probe readings when the encoder passes given values.
+    By default the card is accessed through its DLL; supply a different backend (e.g. a simulated one) to avoid this."""
+
+    def __init__(self, backend=None):
+        dll = DllBackend() if backend is None else backend
+        self.dll = dll
         card_id = ctypes.c_uint16(0)
         # _8102_initial(U16 *CardID_InBit, I16 Manual_ID)
         # Manual_ID: The CardID could be decided by :
@@ -1,4 +1,3 @@
-import visa
 from enum import Enum
 from typing import Union
 import numpy as np
@@ -26,9 +25,11 @@ class InputError(Exception):
 class MetrolabProbe:
     """This class allows communication with a Metrolab Hall probe attached to the USB port."""
 
-    def __init__(self, resource_name='USB0::0x1BFA::0x0498::0000155::INSTR'):
-        rm = visa.ResourceManager()
-        self.probe = rm.open_resource(resource_name, read_termination='\n')
+    def __init__(self, resource_name='USB0::0x1BFA::0x0498::0000155::INSTR', resource_manager=None):
+        if resource_manager is None:  # use VISA unless we've been given something else (e.g. a simulated probe)
+            import visa
+            resource_manager = visa.ResourceManager()
+        self.probe = resource_manager.open_resource(resource_name, read_termination='\n')
 
         # check that we are indeed talking to a Metrolab probe
         if not self.probe.manufacturer_name == 'Metrolab Technology SA':
@@ -38,14 +39,14 @@ class MetrolabProbe:
         self.probe.timeout = 10000
 
         # get range information
-        ranges = self.probe.query(':SENS:ALL?;').split(',')  # ['0.1 T', '0.5 T', ... ]
+        ranges = self.query(':SENS:ALL?;').split(',')  # ['0.1 T', '0.5 T', ... ]
         range_list, unit_list = list(zip(*[rt.split(' ') for rt in ranges]))  # separate out numbers and units
         assert len(set(unit_list)) == 1  # all units returned by this query are the same
         self.range_units = unit_list[0]
         self.ranges = sorted(tuple(float(r) for r in range_list))  # ranges is a tuple of float values
 
         # get unit information - what units can be used?
-        unit_list = self.probe.query(':UNIT:ALL?').split(',')  # 'T,1000000,MT,1000, ...'
+        unit_list = self.query(':UNIT:ALL?').split(',')  # 'T,1000000,MT,1000, ...'
         self.unit_dict = dict(zip(unit_list[0::2], unit_list[1::2]))  # change to dict {'T': 1000000, 'MT': 1000, ... }
 
         self.getUnits()
@@ -58,9 +59,13 @@ class MetrolabProbe:
         if not ret_value.value == 0:
             raise CommunicationError(f'failed sending "{message}" to probe')
 
+    def query(self, message):
+        """Wrapper for sending a message to the probe and reading the answer."""
+        return self.probe.query(message)
+
     def getUnits(self):
         """Find what units the probe will return."""
-        self.units = self.probe.query(':UNIT?')
+        self.units = self.query(':UNIT?')
 
     def setUnits(self, unit_name: str):
         """Set the units to be used by the probe."""
@@ -73,7 +78,7 @@ class MetrolabProbe:
 
     def getAverages(self) -> int:
         """Find out how many averages the probe will take for each reading."""
-        self.averages = int(self.probe.query(':AVER:COUN?'))
+        self.averages = int(self.query(':AVER:COUN?'))
         return self.averages
 
     def setAverages(self, averages: int):
@@ -85,12 +90,12 @@ class MetrolabProbe:
 
     def getRange(self):
         """Find out the sensing range of the probe."""
-        on_off = self.probe.query(':SENS:AUTO?')
+        on_off = self.query(':SENS:AUTO?')
         if on_off not in OnState.__members__:
             raise CommunicationError(f'bad reply to auto-range query: "{on_off}"')
         self.auto_range = OnState[on_off].value  # True or False
         # this query returns (e.g.) "0.100000 T"
-        range_str, units = self.probe.query(':SENS?').split(' ')
+        range_str, units = self.query(':SENS?').split(' ')
         assert units == self.range_units
         self.range = float(range_str)
         return self.auto_range, self.range
@@ -121,9 +126,9 @@ class MetrolabProbe:
         assert digits in (1, 2, 3, 4, 5)
         assert isinstance(count, int) and 1 <= count <= 2048
         if fetch:  # fetch previously-gathered values
-            values = self.probe.query(f':FETC:ARR:{direction}? {count},{digits}').split(',')
+            values = self.query(f':FETC:ARR:{direction}? {count},{digits}').split(',')
         else:  # just do a measurement now
-            values = self.probe.query(f':READ:ARR:{direction}? {count},,{digits}').split(',')  # extra omitted argument is <expected_value>
+            values = self.query(f':READ:ARR:{direction}? {count},,{digits}').split(',')  # extra omitted argument is <expected_value>
         return [float(value.split(' ')[0]) for value in values]
 
     def abortTrigger(self):
@@ -145,3 +150,7 @@ class MetrolabProbe:
     def armTrigger(self):
         """Start triggering the probe."""
         self.send(':INIT')  # initiate
+
+    def trigger(self):
+        """Send a bus trigger to the probe."""
+        self.probe.assert_trigger()
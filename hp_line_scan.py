@@ -1,7 +1,8 @@
+import concurrent.futures
 import numpy as np
-import motor_controller
+from time import perf_counter, sleep
 import hall_probe
-import adlink_card
+import instrument_session
 
 
 class InputError(Exception):
@@ -23,60 +24,259 @@ def arange(start, stop=None, step=1.0):
 class LineScan:
     """Class to enable scanning a Hall probe along a line in a given direction."""
 
-    def __init__(self, axis_name, start, stop, step, hp_avgs=100, hp_range=0.1, mc=None, min_trigger_time=0.2):
-        # usually would provide a motor controller instance to avoid permission errors
-        self.mc = motor_controller.MotorController() if mc is None else mc
-        if axis_name not in ('x', 'y', 'z'):
+    def __init__(self, axis_name, start, stop, step, hp_avgs=100, hp_range=0.1, mc=None, min_trigger_time=0.2,
+                 card=None, hp=None, session=None, software_on_the_fly=False, probes=None):
+        # usually would provide an instrument session (or a motor controller instance) to avoid permission errors
+        # and so that the instruments are only set up once for a sequence of scans
+        self.session = instrument_session.InstrumentSession(mc=mc, hp=hp, card=card) if session is None else session
+        if axis_name not in ('x', 'y', 'z', 's'):
             raise InputError(f"can't scan along axis '{axis_name}'")
         self.axis_name = axis_name
-        self.axis = self.mc.axis[axis_name]
-        self.hp = hall_probe.MetrolabProbe()
-        self.hp.setAverages(hp_avgs)
-        self.hp.setRange(hp_range)
+        self.axis = self.session.axis(axis_name)
+        # several probes can be used at once: give a dict of {resource name: (x, y, z) offset in mm}
+        if probes is None:
+            self.probes = [(self.session.hp, np.zeros(3))]
+        else:
+            self.probes = [(self.session.probe(name), np.array(offset, dtype=float)) for name, offset in probes.items()]
+        self.hp = self.probes[0][0]
+        # with several probes, talk to them in parallel
+        self.executor = concurrent.futures.ThreadPoolExecutor(len(self.probes)) if len(self.probes) > 1 else None
+        self.hp_avgs = hp_avgs
+        # hp_range is a fixed range, None for auto-ranging, or one of these to choose a fixed range for each line:
+        # 'pre-scan' for a quick sweep along the line first, 'previous' to go by the previous line
+        if isinstance(hp_range, str) and hp_range not in ('pre-scan', 'previous'):
+            raise InputError(f"can't interpret range '{hp_range}'")
+        self.hp_range = hp_range
+        self.range_margin = 1.1  # headroom when choosing a range
+        self.line_ranges = {}  # line key: range for each probe
+        self.previous_peaks = None  # largest field component seen by each probe on the last line, in range units
+        self.configureProbes()
         self.start = start
         self.stop = stop
         self.step = step
         self.pos_values = arange(start, stop, step)
         self.n_steps = len(self.pos_values)
         self.field_values = np.zeros((len(self.pos_values), 3))
+        self.probe_field_values = [self.field_values] * len(self.probes)
+        # SCL drives don't understand 'sv', so the ZEPTO stroke axis runs at its configured (maximum) speed
+        self.fixed_speed = self.axis.version == 'SCL'
+        speed = min(self.step / min_trigger_time, self.axis.max_speed)  # set time longer if get MissedTriggerErrors
+        self.speed = self.axis.max_speed if self.fixed_speed else speed
+        self.run_up = 0
+        self.software_trigger = False
         if axis_name in ('x', 'z'):
             self.on_the_fly = True
-            ad8102 = adlink_card.AdlinkCard()
-            self.enc_axis = ad8102.axis['z']#axis_name]
-            speed = min(self.step / min_trigger_time, self.axis.max_speed)  # set time longer if get MissedTriggerErrors
-            print(f'speed = {speed:.3f} mm/s')
-            self.speed = speed
-            self.axis.setSpeed()  # max speed to get to start position
-        else:
+            self.enc_axis = self.session.card.axis['z']#axis_name]
+            self.enc_sync = self.session.encoderSync(self.axis, self.enc_axis)
+        else:  # no encoder card wiring for these axes
             self.on_the_fly = False
             self.enc_axis = None
+            self.enc_sync = None
+            if software_on_the_fly:
+                self.software_trigger = True
+                # far enough to get up to speed, and to get a couple of position readings at full speed
+                self.run_up = self.runUp(self.speed ** 2 / (2 * self.axis.acceleration), self.speed * 0.5)
+        if self.on_the_fly or self.software_trigger:
+            print(f'speed = {self.speed:.3f} mm/s')
+            self.setSpeed()  # max speed to get to start position
+
+    @property
+    def mc(self):
+        return self.session.mc  # only opened when needed, so that a stroke scan doesn't open COM1
+
+    def runUp(self, needed, margin):
+        """Return the run-up for a software on-the-fly scan: needed plus as much of margin as the soft limits allow
+        at both ends of the line."""
+        limits = None if self.axis.version == 'SCL' else self.axis.getLimits()  # SCL drives can't be asked
+        if limits is None:
+            return needed + margin
+        room = min(min(self.start, self.stop) - min(limits), max(limits) - max(self.start, self.stop))
+        if room < needed:
+            raise InputError(f'not enough room within the soft limits {limits} of axis {self.axis_name} to get up to '
+                             f'speed: {needed:.3f} mm needed, {max(room, 0):.3f} mm available')
+        return min(needed + margin, room)
+
+    def setSpeed(self, speed=None):
+        """Set the axis speed (None for maximum), if it can be set."""
+        if not self.fixed_speed:
+            self.session.setSpeed(self.axis, speed)
+
+    def forEachProbe(self, func):
+        """Call func(probe) for each probe, in parallel if there are several, and return a list of the results."""
+        if self.executor is None:
+            return [func(self.hp)]
+        return list(self.executor.map(func, [hp for hp, offset in self.probes]))
+
+    def configureProbes(self, ranges=None):
+        """Set the averages and range of the probe(s). Give a list of ranges to use those instead of hp_range."""
+        for i, (hp, offset) in enumerate(self.probes):
+            self.session.setAverages(hp, self.hp_avgs)
+            if ranges is not None:
+                self.session.setRange(hp, ranges[i])
+            elif not isinstance(self.hp_range, str):  # otherwise chosen for each line
+                self.session.setRange(hp, self.hp_range)
+
+    def peakFields(self, probe_field_values):
+        """Return the largest field component measured by each probe, in the units of its ranges."""
+        return [np.max(np.abs(field_values)) * float(hp.unit_dict[hp.units]) / float(hp.unit_dict[hp.range_units])
+                for (hp, offset), field_values in zip(self.probes, probe_field_values)]
+
+    def tightestRange(self, hp, peak):
+        """Return the smallest range of the probe that will measure the given field (in range units) with some
+        headroom."""
+        return next((r for r in hp.ranges if peak * self.range_margin < r), hp.ranges[-1])
+
+    def preScan(self):
+        """Sweep along the line at full speed, taking readings with the probe(s) auto-ranging, and return the largest
+        field component seen by each probe (in range units)."""
+        for hp, offset in self.probes:
+            self.session.setRange(hp, None)
+            self.session.setTrigger(hp, hall_probe.TriggerSource.IMMEDIATE, 1)
+        self.setSpeed()
+        self.axis.move(self.start, wait=True)
+        print('Pre-scan to:', self.stop)
+        self.axis.move(self.stop)
+        timeout = abs(self.stop - self.start) / self.axis.max_speed + 30  # as Axis.move
+        start = perf_counter()
+        peaks = [0.0] * len(self.probes)
+        while True:
+            fields = self.forEachProbe(lambda hp: hp.getField(count=10))
+            peaks = np.maximum(peaks, self.peakFields(fields))
+            if abs(self.axis.get_position(set_value=False) - self.stop) < 0.01:
+                return list(peaks)
+            if perf_counter() - start > timeout:
+                self.axis.stop()
+                raise TimeoutError(f'Timed out waiting for axis {self.axis_name} to reach {self.stop} in the pre-scan')
+
+    def selectRanges(self, line_key=None):
+        """Choose the tightest fixed range for each probe on this line, from a pre-scan or from the previous line.
+        The choice is remembered for the line, given by line_key (e.g. the positions of the other axes)."""
+        if line_key not in self.line_ranges:
+            if self.hp_range == 'previous' and self.previous_peaks is not None:
+                peaks = self.previous_peaks
+            else:
+                peaks = self.preScan()
+            self.line_ranges[line_key] = [self.tightestRange(hp, peak) for (hp, offset), peak in zip(self.probes, peaks)]
+            print('Probe range:', ', '.join(f'{r:g}' for r in self.line_ranges[line_key]), self.hp.range_units)
+        return self.line_ranges[line_key]
+
+    def run(self, line_key=None):
+        """Move to the start position, set up triggers if necessary, and run the scan.
+        If the range is chosen for each line, line_key identifies the line (e.g. the positions of the other axes) so
+        that the choice can be reused. If any probe saturates, the line is run again with a higher range."""
+        if not isinstance(self.hp_range, str):
+            # Another scan in the same session might have changed these
+            self.configureProbes()
+            self.acquire()
+            return
+        ranges = self.selectRanges(line_key)
+        while True:
+            self.configureProbes(ranges)
+            self.acquire()
+            self.previous_peaks = self.peakFields(self.probe_field_values)
+            # readings at (or very close to) the range are over range
+            over = [peak >= 0.99 * r and r < hp.ranges[-1]
+                    for (hp, offset), peak, r in zip(self.probes, self.previous_peaks, ranges)]
+            if not any(over):
+                return
+            ranges = [next(x for x in hp.ranges if x > r) if o else r
+                      for (hp, offset), r, o in zip(self.probes, ranges, over)]
+            self.line_ranges[line_key] = ranges
+            print('Over range: running the line again with range', ', '.join(f'{r:g}' for r in ranges))
 
-    def run(self):
-        """Move to the start position, set up triggers if necessary, and run the scan."""
-        # Move to start
-        self.axis.move(self.start, wait=True, tolerance=0.001)
+    def setUpTriggers(self, hp):
+        """Get a probe ready to take a reading each time it is triggered."""
+        hp.abortTrigger()
+        self.session.setTrigger(hp, hall_probe.TriggerSource.BUS, self.n_steps)
+        hp.armTrigger()
+
+    def trigger(self):
+        """Trigger a reading from all the probes at once."""
+        if self.executor is None:
+            self.hp.trigger()
+        else:
+            self.forEachProbe(hall_probe.MetrolabProbe.trigger)
+
+    def acquire(self):
+        """Move to the start position, set up triggers if necessary, and take the readings along the line."""
+        # Move to start (or a little before it for a software on-the-fly scan, to get up to speed)
+        direction_sign = np.copysign(1, self.stop - self.start)
+        self.axis.move(self.start - direction_sign * self.run_up, wait=True, tolerance=0.001)
 
         # Set up triggers
-        self.hp.abortTrigger()
-        self.hp.setTriggerSource(hall_probe.TriggerSource.BUS)
-        self.hp.setTriggerCount(self.n_steps)
-        self.hp.armTrigger()
+        self.forEachProbe(self.setUpTriggers)
+
+        if self.software_trigger:
+            self.setSpeed(self.speed)
+            self.scanSoftwareOnTheFly()
+            self.fetchField()
+            return
 
         # Get the first field reading
-        self.hp.probe.assert_trigger()
+        self.trigger()
 
         if self.on_the_fly:
-            self.axis.setSpeed(self.speed)
-            # Set Adlink encoder position equal to that read by the McLennan motor controller
-            mc_encoder_pos = self.axis.get_position(set_value=False) * self.axis.scale_factor
-            # print('Z encoder position (from MC):', mc_encoder_pos)
-            self.enc_axis.setPosition(mc_encoder_pos)
-            # print('Encoder position (from Adlink):', self.enc_axis.getPosition())
+            self.setSpeed(self.speed)
+            # Make sure the Adlink encoder position agrees with that read by the McLennan motor controller
+            self.enc_sync.follow(self.axis)  # another line scan may have used the counter for a different axis
+            self.enc_sync.ensureSynced()
             self.scanOnTheFly()
         else:
             self.scanPointByPoint()
 
-        self.field_values = self.hp.getField(count=self.n_steps, fetch=True)
+        self.fetchField()
+        if self.on_the_fly:
+            self.enc_sync.check()  # the axis has usually stopped by now; if not, check before the next line
+
+    def runPasses(self, target_std_err=None, max_passes=10, min_passes=2, line_key=None):
+        """Run the scan repeatedly, keeping a running mean and variance of the field at each point (Welford's method).
+        Stop after max_passes, or as soon as the standard error of every point is below target_std_err (in the probe's
+        units) after at least min_passes. The field values are then the mean, with their standard errors in
+        field_std_err."""
+        min_passes = max(min_passes, 2)  # need at least two to estimate the error
+        mean = np.zeros((len(self.probes), self.n_steps, 3))
+        sum_sq = np.zeros_like(mean)  # sum of squared differences from the mean
+        std_err = np.full_like(mean, np.inf)
+        for n in range(1, max_passes + 1):
+            self.run(line_key)
+            values = np.array(self.probe_field_values)
+            delta = values - mean
+            mean += delta / n
+            sum_sq += delta * (values - mean)
+            if n > 1:
+                std_err = np.sqrt(sum_sq / (n - 1) / n)
+                print(f'Pass {n}: max standard error {std_err.max():.3g}')
+            if n >= min_passes and target_std_err is not None and std_err.max() < target_std_err:
+                break
+        self.passes = n
+        self.probe_field_values = list(mean)
+        self.probe_field_std_err = list(std_err)
+        self.field_values = mean[0]
+        self.field_std_err = std_err[0]
+
+    def fetchField(self):
+        """Fetch the readings from the probe(s). For a software on-the-fly scan, interpolate them from the positions
+        at which they were triggered onto the scan positions."""
+        self.probe_field_values = self.forEachProbe(lambda hp: np.array(hp.getField(count=self.n_steps, fetch=True)))
+        if self.software_trigger:
+            order = np.argsort(self.trigger_positions)
+            positions = self.trigger_positions[order]
+            self.probe_field_values = [np.transpose([np.interp(self.pos_values, positions, field[order])
+                                                     for field in np.transpose(field_values)])
+                                       for field_values in self.probe_field_values]
+        self.field_values = self.probe_field_values[0]
+
+    def merged(self, fixed_positions=None):
+        """Return the (x, y, z) positions and field values from all the probes as two arrays, allowing for the offset
+        of each probe. fixed_positions is a dict giving the positions of the other axes (0 if not given)."""
+        stage = np.zeros((self.n_steps, 3))
+        for axis_name, value in (fixed_positions or {}).items():
+            if axis_name in ('x', 'y', 'z'):
+                stage[:, 'xyz'.index(axis_name)] = value
+        if self.axis_name in ('x', 'y', 'z'):
+            stage[:, 'xyz'.index(self.axis_name)] = self.pos_values
+        positions = np.concatenate([stage + offset for hp, offset in self.probes])
+        return positions, np.concatenate(self.probe_field_values)
 
     def scanOnTheFly(self):
         """Run an on-the-fly scan."""
@@ -90,17 +290,57 @@ class LineScan:
             print(f'Waiting for position {trigger_at}, now at {pos_now}')
             if np.copysign(1, trigger_at - pos_now) != direction_sign:  # already passed the trigger!
                 raise MissedTriggerError(f'Missed trigger at {trigger_at}, already at {pos_now}')
-            self.enc_axis.waitForPosition(trigger_at)
-            self.hp.probe.assert_trigger()
+            # stop straight away if the trigger event is missed, rather than waiting for the timeout
+            self.enc_axis.waitForPositionAsync(trigger_at, on_overshoot=self.axis.stop).result()
+            self.trigger()
+
+        self.setSpeed()  # set back to max speed
+
+    def scanSoftwareOnTheFly(self, poll_interval=0.01):
+        """Run an on-the-fly scan without the encoder card. While the axis moves at constant speed, read its position
+        as fast as the controller allows, predict when each point will be reached and trigger the probe then.
+        The positions at the trigger times are then interpolated from the position readings, so that the field values
+        can be interpolated back onto the regular grid of scan positions."""
+        direction_sign = np.copysign(1, self.stop - self.start)
+        end = self.stop + direction_sign * self.run_up
+        timeout = abs(end - self.start) / self.speed + 30
+        print('Moving to:', end)
+        samples = []  # (time, position)
+        trigger_times = []
+        self.axis.move(end)
+        start = perf_counter()
+        i = 0
+        while i < self.n_steps or samples[-1][0] < trigger_times[-1]:  # one sample after the last trigger
+            t = perf_counter()  # the controller reads the position as soon as it gets the command
+            samples.append((t, self.axis.get_position(set_value=False, poll_interval=poll_interval)))
+            if t - start > timeout:
+                raise TimeoutError(f'Timed out waiting for axis {self.axis_name} to reach {self.pos_values[i]}')
+            if len(samples) < 2:
+                continue
+            (t0, p0), (t1, p1) = samples[-2:]
+            velocity = (p1 - p0) / (t1 - t0)
+            if velocity * direction_sign <= 0:  # not moving yet
+                continue
+            next_sample = 2 * t1 - t0 + (perf_counter() - t1)  # assume the next reading takes as long as the last
+            # Fire all the triggers we expect before the next position reading
+            while i < self.n_steps and (trigger_at := t1 + (self.pos_values[i] - p1) / velocity) < next_sample:
+                delay = trigger_at - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+                trigger_times.append(perf_counter())
+                self.trigger()
+                i += 1
 
-        self.axis.setSpeed()  # set back to max speed
+        self.setSpeed()  # set back to max speed
+        sample_times, sample_positions = np.transpose(samples)
+        self.trigger_positions = np.interp(trigger_times, sample_times, sample_positions)
 
     def scanPointByPoint(self):
         """Run a point-by-point scan."""
         for i, pos in enumerate(self.pos_values[1:]):
             print(pos)
             self.axis.move(pos, wait=True)
-            self.hp.probe.assert_trigger()
+            self.trigger()
 
 
 if __name__ == '__main__':
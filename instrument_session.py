@@ -0,0 +1,180 @@
+"""Instrument session: open the motor controllers, Hall probe(s) and encoder card once, and reuse them."""
+from datetime import datetime
+from time import sleep
+import hall_probe
+import adlink_card
+import motor_controller
+import motion_server
+
+
+class EncoderSync:
+    """Keeps an encoder card counter in step with the actual position read by the motor controller.
+    The counter is set from the controller once; after that, drift between the two is checked when the axis is
+    stationary, and the counter is only set again if the drift is more than the threshold (in mm).
+    One card counter can be wired to different motor axes in turn: use follow() to switch, which sets it again."""
+
+    def __init__(self, axis, enc_axis, threshold=0.01):
+        self.axis = axis
+        self.enc_axis = enc_axis
+        if hasattr(enc_axis, 'follow'):
+            enc_axis.follow(axis)
+        self.threshold = threshold
+        self.synced = False
+        self.check_pending = False  # a check was put off because the axis was still moving
+        self.drift = None  # card minus controller position in mm, from the last check
+        self.history = []  # (time, drift in mm) for each time the counter was set again
+
+    def follow(self, axis):
+        """Make the card counter follow a different motor axis, setting it again before it is next used."""
+        if axis is not self.axis:
+            self.axis = axis
+            if hasattr(self.enc_axis, 'follow'):  # a simulated counter has to be linked to the new axis
+                self.enc_axis.follow(axis)
+            self.synced = False
+            self.check_pending = False
+            self.drift = None
+
+    def sync(self, position=None):
+        """Set the card counter to the controller's actual position (in mm, read from the controller if not given)."""
+        if position is None:
+            position = self.axis.get_position(set_value=False)
+        self.enc_axis.setPosition(position * self.axis.scale_factor)
+        self.synced = True
+        self.check_pending = False
+
+    def ensureSynced(self):
+        """Set the card counter if it hasn't been set yet, or check for drift if a previous check was skipped."""
+        if not self.synced:
+            self.sync()
+        elif self.check_pending and self.check() is None:
+            raise adlink_card.EncoderException(f'Axis {self.axis.id} is still moving: '
+                                               f'can\'t check the encoder card against the controller')
+
+    def check(self, retries=5, settle_time=0.1):
+        """Compare the card and controller positions, setting the card counter again if they have drifted apart.
+        The card is read either side of the controller: if the two readings differ the axis is moving, so they are
+        taken again after settle_time seconds, up to retries times. If the axis still hasn't settled, the check is put
+        off until ensureSynced() is next called. Return the drift in mm, or None if the check was put off."""
+        if not self.synced:
+            self.sync()
+            return 0.0
+        for attempt in range(retries + 1):
+            before = self.enc_axis.getPosition()
+            position = self.axis.get_position(set_value=False)
+            if self.enc_axis.getPosition() == before:
+                break
+            if attempt < retries:
+                sleep(settle_time)
+        else:
+            print(f'Axis {self.axis.id} still moving after {retries} retries: checking the encoder card later')
+            self.check_pending = True
+            return None
+        self.check_pending = False
+        self.drift = before / self.axis.scale_factor - position
+        if abs(self.drift) > self.threshold:
+            print(f'Encoder drift of {self.drift:.4f} mm on axis {self.axis.id}: setting the card position again')
+            self.history.append((datetime.now(), self.drift))
+            self.sync(position)
+        return self.drift
+
+
+class InstrumentSession:
+    """Opens each instrument the first time it is needed and keeps it open, so that a sequence of scans only pays
+    the start-up cost once. Instrument settings are tracked, and only settings that have changed are sent.
+    Instruments that are already open (or simulated) can be supplied instead."""
+
+    def __init__(self, mc=None, hp=None, card=None, zepto=None, probes=None):
+        self._mc = mc
+        self._zepto = zepto
+        self._card = card
+        self.probes = dict(probes or {})  # resource name: MetrolabProbe, with None for the default one
+        if hp is not None:
+            self.probes[None] = hp
+        self.speeds = {}  # axis: speed last set (None for maximum)
+        self.triggers = {}  # probe: (trigger source, trigger count) last set
+        self.encoder_syncs = {}  # encoder axis: EncoderSync
+
+    @property
+    def mc(self):
+        if self._mc is None:
+            self._mc = motion_server.connect()  # share the motion server's connection if it's running
+        return self._mc
+
+    @property
+    def zepto(self):
+        if self._zepto is None:
+            self._zepto = motor_controller.ZeptoDipoleController()
+        return self._zepto
+
+    @property
+    def card(self):
+        if self._card is None:
+            self._card = adlink_card.AdlinkCard()
+        return self._card
+
+    def probe(self, resource_name=None):
+        """Return the Hall probe with the given VISA resource name, opening it if necessary."""
+        if resource_name not in self.probes:
+            args = () if resource_name is None else (resource_name, )
+            self.probes[resource_name] = hall_probe.MetrolabProbe(*args)
+        return self.probes[resource_name]
+
+    @property
+    def hp(self):
+        """The default Hall probe."""
+        return self.probe()
+
+    def axis(self, axis_name):
+        """Return the named axis, using the ZEPTO dipole controller for the stroke axis 's' unless the motion server
+        serves it. The main motor controller isn't opened just to look for 's'."""
+        if axis_name == 's':
+            if self._mc is None:
+                try:
+                    self._mc = motion_server.MotionClient()
+                except (FileNotFoundError, ConnectionRefusedError):  # no server: leave COM1 alone
+                    return self.zepto.axis
+            return self._mc.axis['s'] if 's' in self._mc.axis else self.zepto.axis
+        return self.mc.axis[axis_name]
+
+    def encoderSync(self, axis, enc_axis):
+        """Return the object that keeps the encoder card counter in step with the given axis. There is one for each
+        counter, so if it was last following a different axis, it will be set again before it is next used."""
+        if enc_axis not in self.encoder_syncs:
+            self.encoder_syncs[enc_axis] = EncoderSync(axis, enc_axis)
+        self.encoder_syncs[enc_axis].follow(axis)
+        return self.encoder_syncs[enc_axis]
+
+    def setSpeed(self, axis, speed=None):
+        """Set the slew speed of an axis (None for its maximum speed) unless it is already set."""
+        if axis not in self.speeds or self.speeds[axis] != speed:
+            axis.setSpeed(speed)
+            self.speeds[axis] = speed
+
+    def setAverages(self, hp, averages):
+        """Set the number of averages taken by the probe, unless it is already set."""
+        if hp.averages != averages:
+            hp.setAverages(averages)
+
+    def setRange(self, hp, r=None):
+        """Set the probe range (None for automatic ranging), unless it is already set."""
+        if r is None:
+            if not hp.auto_range:
+                hp.setRange(None)
+            return
+        allowed = next((x for x in hp.ranges if float(r) <= x), None)  # setRange will pick this one
+        if hp.auto_range or hp.range != allowed:
+            hp.setRange(r)
+
+    def setUnits(self, hp, units):
+        """Set the units used by the probe, unless they are already set."""
+        if hp.units != units.upper():
+            hp.setUnits(units)
+
+    def setTrigger(self, hp, source, count):
+        """Set the trigger source and count for the probe, unless they are already set."""
+        old_source, old_count = self.triggers.get(hp, (None, None))
+        if source != old_source:
+            hp.setTriggerSource(source)
+        if count != old_count:
+            hp.setTriggerCount(count)
+        self.triggers[hp] = (source, count)
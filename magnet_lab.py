@@ -0,0 +1,302 @@
+"""Magnet lab command line: run Hall probe scans, convert their output and benchmark the scan code.
+Each subcommand only imports the instrument modules (and numpy, VISA, pyserial, the encoder card DLL...) it needs when
+it runs, so help, dry runs and conversions start quickly. Usage: python magnet_lab.py <subcommand> --help"""
+import argparse
+import sys
+from typing import List
+
+
+def scan_range(arg) -> List:
+    l = [x if i == 0 else float(x) for i, x in enumerate(arg.replace('=', ',').split(','))]
+    if len(l) not in (2, 3, 4) or l[0].lower() not in ('x', 'y', 'z', 's'):
+        raise argparse.ArgumentTypeError(f"Can't interpret range specifier {arg}")
+    return l
+
+
+def line_range(arg) -> List:
+    l = scan_range(arg)
+    if len(l) != 4:
+        raise argparse.ArgumentTypeError(f"Can't interpret line specifier {arg}")
+    return l
+
+
+def probe_spec(arg):
+    name, *offset = arg.split(',')
+    if len(offset) != 3:
+        raise argparse.ArgumentTypeError(f"Can't interpret probe specifier {arg}")
+    return name, tuple(float(d) for d in offset)
+
+
+def probe_range(arg):
+    if arg in ('auto', 'pre-scan', 'previous'):
+        return None if arg == 'auto' else arg
+    try:
+        return float(arg)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Can't interpret probe range {arg}")
+
+
+def describe_range(spec):
+    """Describe a scan specification [axis name, start[, stop[, step]]] without needing numpy."""
+    axis_name, start, *rest = spec
+    if not rest:
+        return f'{axis_name} = {start:g} mm', 1
+    stop, step = rest if len(rest) == 2 else (rest[0], 1.0)
+    n_points = int(abs(stop - start) / abs(step) + 0.002 / abs(step)) + 1  # as hp_line_scan.arange
+    return f'{axis_name} from {start:g} to {stop:g} mm in {abs(step):g} mm steps ({n_points} points)', n_points
+
+
+def dry_run(title, specs, probes=None):
+    """Print what a scan would do, without touching the hardware."""
+    print(f'{title} (dry run):')
+    line, *others = specs
+    description, points_per_line = describe_range(line)
+    print(f'  line scan: {description}')
+    n_lines = 1
+    for spec in others:
+        description, n_points = describe_range(spec)
+        print(f'  for each {description}' if n_points > 1 else f'  at {description}')
+        n_lines *= n_points
+    for axis_name in sorted({'x', 'y', 'z'} - {spec[0] for spec in specs}):
+        print(f'  {axis_name} stays at its current position')
+    n_probes = len(probes) if probes else 1
+    print(f'  {n_lines} lines, {n_lines * points_per_line} points' + (f' from each of {n_probes} probes' if n_probes > 1 else ''))
+    return 0
+
+
+def open_session(args, probes=None):
+    """Return an instrument session, using simulated instruments if asked to.
+    probes is a dict of {resource name: (x, y, z) offset} for any extra probes."""
+    import instrument_session
+    if not args.simulate:
+        if args.record or args.replay:  # talk to the controller directly, so that its I/O goes through the log
+            import motor_controller
+            return instrument_session.InstrumentSession(mc=motor_controller.MotorController())
+        return instrument_session.InstrumentSession()
+    import sim_motor_controller
+    import sim_hall_probe
+    import sim_adlink_card
+    mc = sim_motor_controller.SimulatedMotorController()
+    field_model = sim_hall_probe.SolenoidField()
+    sim_probes = {name: sim_hall_probe.SimulatedMetrolabProbe(field_model, sim_hall_probe.stage_position(mc, offset),
+                                                              resource_name=name)
+                  for name, offset in (probes or {}).items()}
+    return instrument_session.InstrumentSession(
+        mc=mc, hp=sim_hall_probe.SimulatedMetrolabProbe(field_model, sim_hall_probe.stage_position(mc)),
+        card=sim_adlink_card.SimulatedAdlinkCard(mc), zepto=sim_motor_controller.SimulatedZeptoDipoleController(),
+        probes=sim_probes)
+
+
+def output_file(args):
+    """Open the output file given (for appending), or use the console."""
+    return open(args.file, 'a') if args.file else sys.stdout
+
+
+def line_command(args):
+    if args.dry_run:
+        return dry_run('Line scan', [args.scan])
+    import numpy as np
+    import hp_line_scan
+    line_scan = hp_line_scan.LineScan(*args.scan, hp_avgs=args.averages, hp_range=args.range,
+                                      session=open_session(args), software_on_the_fly=args.software_on_the_fly)
+    if args.passes > 1:
+        line_scan.runPasses(args.std_err, max_passes=args.passes)
+    else:
+        line_scan.run()
+    out_file = output_file(args)
+    units = line_scan.hp.units
+    columns = [f'{line_scan.axis_name} [mm]'] + [f'{b} [{units}]' for b in ('Bx', 'By', 'Bz')]
+    field_values = line_scan.field_values
+    if args.passes > 1:
+        columns += [f'std err {b} [{units}]' for b in ('Bx', 'By', 'Bz')]  # as map_scan
+        field_values = np.hstack([field_values, line_scan.field_std_err])
+    print(*columns, sep=',', file=out_file)
+    for position, field in zip(line_scan.pos_values, field_values):
+        print(','.join([f'{p:.5f}' for p in np.insert(field, 0, position)]), file=out_file)
+    if out_file is not sys.stdout:
+        out_file.close()
+    return 0
+
+
+def map_command(args):
+    probes = dict(args.probe) if args.probe else None
+    if args.dry_run:
+        line = next((scan for scan in args.scan if len(scan) > 2), None)
+        if line is None:
+            raise ValueError('No scans specified - only fixed positions.')
+        return dry_run('Map', [line] + [scan for scan in args.scan if scan is not line], probes)  # as map_scan does
+    import map_xy
+    out_file = output_file(args)
+    try:
+        map_xy.map_scan(args.scan, open_session(args, probes), out_file, hp_range=args.range, probes=probes,
+                        passes=args.passes, std_err=args.std_err, publish=args.publish, trace=args.trace,
+                        magnet=args.magnet, current=args.current, comment=args.comment)
+    finally:
+        if out_file is not sys.stdout:
+            out_file.close()
+    return 0
+
+
+def peak_command(args):
+    scan = ['z', args.start, args.stop, args.step]
+    if args.dry_run:
+        return dry_run(f'Peak search at x = {args.x:g} mm, y = {args.y:g} mm', [scan, ['x', args.x], ['y', args.y]])
+    from datetime import datetime
+    import map_z
+    scan_time = datetime.now()
+    results = map_z.find_peak(args.x, args.y, args.start, args.stop, args.step, session=open_session(args),
+                              hp_avgs=args.averages, hp_range=args.range)
+    out_file = output_file(args)
+    map_z.write_peak(out_file, *results, args.x, args.y, scan_time, args.magnet, args.current, args.comment)
+    if out_file is not sys.stdout:
+        out_file.close()
+    return 0
+
+
+def stroke_command(args):
+    if args.dry_run:
+        return dry_run('Stroke scan', [['s', args.start, args.stop, args.step]])
+    import zepto_field_vs_stroke
+    line_scan = zepto_field_vs_stroke.stroke_scan(args.start, args.stop, args.step, session=open_session(args),
+                                                  hp_avgs=args.averages, hp_range=args.range)
+    out_file = output_file(args)
+    zepto_field_vs_stroke.write_stroke(out_file, line_scan)
+    if out_file is not sys.stdout:
+        out_file.close()
+    return 0
+
+
+def convert_command(args):
+    import csv2xlsx
+    for csv_filename in args.csv:
+        print('Written', csv2xlsx.convert(csv_filename, args.output if len(args.csv) == 1 else None))
+    return 0
+
+
+def bench_command(args):
+    import scan_benchmark
+    return scan_benchmark.main(args.args)
+
+
+def add_scan_options(parser, averages=100, hp_range=None):
+    """Options common to the scanning subcommands."""
+    parser.add_argument('-f', '--file', help="filename to save data - print data to console if not specified")
+    parser.add_argument('-a', '--averages', type=int, default=averages, help="number of averages for each reading")
+    parser.add_argument('-r', '--range', type=probe_range, default=hp_range,
+                        help="probe range [T], 'auto' for auto-ranging, or choose a fixed range for each line "
+                             "with 'pre-scan' (a quick sweep first) or 'previous' (from the previous line)")
+    parser.add_argument('--simulate', action='store_true', help="use simulated instruments instead of the hardware")
+    parser.add_argument('--dry-run', action='store_true', help="just show what would be scanned")
+    parser.add_argument('--record', metavar='LOG', help="record all instrument I/O to a binary log file")
+    parser.add_argument('--replay', metavar='LOG', help="replay instrument I/O from a log instead of using the hardware")
+    parser.add_argument('--real-time', action='store_true', help="when replaying, keep to the timing of the recording")
+
+
+def add_metadata_options(parser):
+    parser.add_argument('-c', '--comment', help="comment for the output file")
+    parser.add_argument('-m', '--magnet', help='name of magnet to be scanned')
+    parser.add_argument('-i', '--current', help="current in the magnet [Amps]", type=float)
+
+
+def add_passes_options(parser):
+    parser.add_argument('-n', '--passes', type=int,
+                        help="maximum number of passes to average over for each line (adds standard error columns) - "
+                             "default 1, or 10 if --std-err is given")
+    parser.add_argument('-e', '--std-err', type=float,
+                        help="stop repeating a line once the standard error of each point is below this [T]")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='magnet_lab', description='Hall probe scans of magnets.')
+    subparsers = parser.add_subparsers(dest='command', metavar='command', required=True)
+
+    line = subparsers.add_parser('line', help='scan along a line', description='Scan the Hall probe along a line.')
+    line.add_argument('scan', type=line_range, help="scan axis and range in the format X|Y|Z|S,start,stop,step")
+    add_scan_options(line, hp_range=0.1)
+    line.add_argument('--software-on-the-fly', action='store_true',
+                      help="scan Y or S on the fly, triggering from the controller's position readings (runs up "
+                           "to speed beyond both ends of the line) rather than point by point")
+    add_passes_options(line)
+    line.set_defaults(func=line_command)
+
+    map_parser = subparsers.add_parser('map', help='map the field over a grid', description='Perform a 2D Hall probe scan.',
+                                       epilog='Multiple scan ranges can be specified. The first one is the primary '
+                                              'axis and will preferentially use an on-the-fly scan.')
+    map_parser.add_argument('scan', help="scan axis and range in the format X|Y|Z|S,start[,stop[,step]]",
+                            type=scan_range, nargs='+')
+    add_scan_options(map_parser, hp_range=3.0)
+    add_metadata_options(map_parser)
+    map_parser.add_argument('-p', '--publish', nargs='?', const='',
+                            help="publish each line on a local socket for live monitoring (see scan_publisher.py)")
+    map_parser.add_argument('--probe', type=probe_spec, action='append',
+                            help="Hall probe resource name and offset from the stage position in mm, in the format "
+                                 "RESOURCE,dx,dy,dz - repeat to scan with several probes at once")
+    add_passes_options(map_parser)
+    map_parser.add_argument('-t', '--trace', help="folder to save a trace of instrument calls for each line scan")
+    map_parser.set_defaults(func=map_command)
+
+    peak = subparsers.add_parser('peak', help='find the peak field along z',
+                                 description='Scan along z and fit a parabola to Bz to find the peak.')
+    peak.add_argument('-x', type=float, default=0.0, help="x position [mm]")
+    peak.add_argument('-y', type=float, default=0.0, help="y position [mm]")
+    peak.add_argument('--start', type=float, default=0.0, help="start of z scan [mm]")
+    peak.add_argument('--stop', type=float, default=40.0, help="end of z scan [mm]")
+    peak.add_argument('--step', type=float, default=0.5, help="z step [mm]")
+    add_scan_options(peak, hp_range=0.1)
+    add_metadata_options(peak)
+    peak.set_defaults(func=peak_command)
+
+    stroke = subparsers.add_parser('stroke', help='measure the ZEPTO dipole field against stroke',
+                                   description='On-the-fly scan along the stroke axis of the ZEPTO dipole.')
+    stroke.add_argument('--start', type=float, default=0.0, help="start of stroke scan [mm]")
+    stroke.add_argument('--stop', type=float, default=400.0, help="end of stroke scan [mm]")
+    stroke.add_argument('--step', type=float, default=0.5, help="stroke step [mm]")
+    add_scan_options(stroke)
+    stroke.set_defaults(func=stroke_command)
+
+    convert = subparsers.add_parser('convert', help='convert map CSV files to Excel',
+                                    description='Convert map CSV files to Excel workbooks with a grid for each '
+                                                'field component.')
+    convert.add_argument('csv', nargs='+', help="CSV file(s) written by a map")
+    convert.add_argument('-o', '--output', help="Excel filename (default: same name as the CSV file)")
+    convert.set_defaults(func=convert_command)
+
+    bench = subparsers.add_parser('bench', help='benchmark scan throughput against simulated hardware',
+                                  description='Run scan_benchmark.py (see "bench -h").', add_help=False)
+    bench.add_argument('args', nargs=argparse.REMAINDER, help="arguments for scan_benchmark.py")
+    bench.set_defaults(func=bench_command)
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['bench']:  # all the options (including -h) belong to scan_benchmark
+        import scan_benchmark
+        return scan_benchmark.main(argv[1:])
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if hasattr(args, 'passes'):
+        if args.passes is None:
+            args.passes = 1 if args.std_err is None else 10
+        elif args.std_err is not None and args.passes < 2:
+            parser.error('--std-err needs more than one pass')
+    log = None
+    if getattr(args, 'replay', None) and not args.dry_run:
+        if args.simulate or args.record:
+            parser.error('--replay can\'t be used with --simulate or --record')
+        import scan_replay
+        log = scan_replay.Replay(args.replay, real_time=args.real_time)
+    elif getattr(args, 'record', None) and not args.dry_run:
+        import scan_replay
+        log = scan_replay.Recorder(args.record)
+    if log is None:
+        return args.func(args)
+    log.enable()
+    try:
+        return args.func(args)
+    finally:
+        log.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,168 +1,193 @@
+"""Map the field of a magnet over a grid of points: a LineScan along the first axis for each combination of positions
+of the other axes. Run from the command line with "magnet_lab.py map" (or this script, which does the same)."""
 import sys
-import os
 import numpy as np
-import motor_controller
 import hp_line_scan
+import instrument_session
+import scan_publisher
 from adlink_card import EncoderException
 from datetime import datetime
-import argparse
-from typing import List
 from collections import OrderedDict
 
 
-def scan_range(arg) -> List:
-    l = [x if i == 0 else float(x) for i, x in enumerate(arg.replace('=', ',').split(','))]
-    if len(l) not in (2, 3, 4) or l[0].lower() not in ('x', 'y', 'z', 's'):
-        raise argparse.ArgumentTypeError(f"Can't interpret range specifier {arg}")
-    return l
-
-
-# Parse the input arguments
-parser = argparse.ArgumentParser(description='Perform a 2D Hall probe scan.',
-                                 epilog='Multiple scan ranges can be specified. The first one is the primary axis and will preferentially use an on-the-fly scan.')
-parser.add_argument('scan', help="scan axis and range in the format X|Y|Z,start[,stop[,step]]", type=scan_range,
-                    action='append', nargs='+')
-parser.add_argument('-f', '--file', help="filename to save data - print data to console if not specified")
-parser.add_argument('-c', '--comment', help="comment for the output file")
-parser.add_argument('-m', '--magnet', help='name of magnet to be scanned')
-parser.add_argument('-i', '--current', help="current in the magnet [Amps]", type=float)
-
-args = parser.parse_args()
-scans = args.scan[0]
-
-# Ensure we are doing at least one scan!
-# TODO: in the future, allow this
-if all([len(scan) < 3 for scan in scans]):
-    raise ValueError('No scans specified - only fixed positions.')
-
-# Ensure first argument is a scan, not a fixed position
-for i, scan in enumerate(scans):
-    if len(scan) > 2:
-        scans.insert(0, scans.pop(i))
-        break
-
-mc = motor_controller.MotorController()
-line_scan = hp_line_scan.LineScan(*scans[0], mc=mc)
-# Are the other axes specified? If not, add them as a 'scan' in a single position
-scan_dirs = {scan[0] for scan in scans}
-dirs = {'x', 'y', 'z'}
-unlisted_dirs = dirs - scan_dirs
-for direction in unlisted_dirs:
-    scans.append([direction, mc.axis[direction].get_position()])
-
-# Using the ZEPTO dipole with a 'stroke' axis?
-if 's' in scan_dirs:
-    dipole_ctrl = motor_controller.ZeptoDipoleController()
-    mc.axis['s'] = dipole_ctrl.axis  # this is perhaps a little hacky, but should work
-
-# Convert each remaining scan specification into a tuple of ('axis_name', array([val1, val2, ...]) )
-scans = [(scan[0], hp_line_scan.arange(*scan[1:])) for scan in scans[1:]]
-
-# Concatenate arrays together, so that "x=1,2,3 y=1 x=5,6,7" -> "x=1,2,3,5,6,7 y=1"
-scan_dict = OrderedDict()
-for axis_name, scan_array in scans:
-    scan_dict[axis_name] = np.concatenate([scan_dict[axis_name], scan_array]) if axis_name in scan_dict.keys() else scan_array
-
-# Metadata for the file
-magnet = args.magnet
-current = args.current
-comment = args.comment
-
-# magnet = 'PITZ Compensation Solenoid'
-# current = 30
-# comment = 'YZ scan at X centre +10mm'
-
-# Where to save the file(s)?
-# path = r'\\fed.cclrc.ac.uk\Org\NLab\ASTeC\Apsv4\Astec\IDs and Magnets\Data\PITZ solenoids\Compensation solenoid 15050'
-# basename = '17 yz scan (x centre +10mm)'
-
-# Set up the scan
-hp = line_scan.hp
-field_units = 'T'
-hp.setUnits(field_units)
-hp.setRange(3.0)  # TODO: add to options
-
-# Produce a header for the file(s)
-header = [('Date/time', datetime.now().strftime('%d/%m/%y %H:%M:%S')),
-          ('Magnet under test', magnet) if magnet else (),
-          ('Magnet current [A]', current) if current else (),
-          ('Probe', f'{hp.probe.manufacturer_name} {hp.probe.model_name} S/N {hp.probe.serial_number}'),
-          ('Averages', hp.getAverages()),
-          ('Probe range', hp.getRange()[1]),
-          ('Comment', comment) if comment else (),
-          ]
-
-columns = ''
-for axis_name, scan_array in scan_dict.items():
-    if len(scan_array) == 1:
-        header.append((f'{axis_name} position [mm]', scan_array[0]))
-    else:
-        columns += f'{axis_name} [mm],'
-columns += f'{line_scan.axis_name} [mm]'
-
-# Write header and columns to CSV file
-out_file = open(args.file, 'a') if args.file else sys.stdout
-[print(*l, sep=',', file=out_file) for l in header if l]
-print(f'{columns},Bx [{field_units}],By [{field_units}],Bz [{field_units}]', file=out_file)
-
-# we should have two or three axes to scan over (e.g. X, Y, and stroke, with a LineScan in Z)
-assert len(scan_dict) in (2, 3)
-scan_index = 0
-start = datetime.now()
-eta = None
-
-axis2 = list(scan_dict)[0]
-ax2_values = scan_dict[axis2]
-axis3 = list(scan_dict)[1]
-ax3_values = scan_dict[axis3]
-if len(scan_dict) >= 3:
-    axis4 = list(scan_dict)[2]
-    ax4_values = scan_dict[axis4]
-else:
-    axis4 = None
-    ax4_values = [0]
-
-n_line_scans = len(ax2_values) * len(ax3_values) * len(ax4_values)
-
-for k, s in enumerate(ax4_values):
-    if axis4 is not None:
-        print(f'{axis4} = {s} mm')
-        mc.axis[axis4].move(s, wait=True)
-
-    for j, z in enumerate(ax3_values):
-        print(f'{axis3} = {z} mm')
-        mc.axis[axis3].move(z, wait=True)
-
-        # Run the scan, invoking line_scan for each position along axis 2
-        for i, y in enumerate(ax2_values):
-            if i > 0:
-                progress = i / n_line_scans
-                elapsed = datetime.now() - start
-                eta = start + elapsed / progress
-            print(f'{axis2} = {y} mm' + (eta.strftime(', ETA %H:%M') if eta else ''))
-            mc.axis[axis2].move(y, wait=True)
-            tries = 0
-            ok = False
-            while not ok:
-                try:
-                    line_scan.run()
-                    ok = True
-                except (hp_line_scan.MissedTriggerError, EncoderException) as e:  # sometimes we get a little hiccup
-                    line_scan.axis.stop()
-                    tries += 1
-                    print(e)
-                    if tries % 5 == 0 and input(f'Scan failed after {tries} tries. Try again? [Y/n]').upper() not in ('', 'Y'):
-                        raise  # break out
-            # line_scan.field_values = np.random.rand(len(line_scan.pos_values), 3) - 0.5  # for testing!
-
-            # Record the data in the file(s)
-            pos_vector = [z] if len(ax3_values) > 1 else []
-            if len(ax2_values) > 1:
-                pos_vector.append([y])
-            for column, (x, field) in enumerate(zip(line_scan.pos_values, line_scan.field_values)):
-                print(','.join([f'{p:.5f}' for p in np.concatenate([[y, x], field])]), file=out_file, flush=True)
-
-            # Save as we go along in case of unforeseen errors
-            out_file.flush()
-
-out_file.close()
+def probe_offset(axis_name, offset):
+    """Offset of a probe along the named axis (none along the stroke axis)."""
+    return offset['xyz'.index(axis_name)] if axis_name in ('x', 'y', 'z') else 0.0
+
+
+def order_scans(scans):
+    """Check a list of scan specifications [axis name, start[, stop[, step]]] and return it with the first one that is
+    a scan (rather than a fixed position) at the front."""
+    # Ensure we are doing at least one scan!
+    # TODO: in the future, allow this
+    if all([len(scan) < 3 for scan in scans]):
+        raise ValueError('No scans specified - only fixed positions.')
+
+    # Ensure first argument is a scan, not a fixed position
+    scans = list(scans)
+    for i, scan in enumerate(scans):
+        if len(scan) > 2:
+            scans.insert(0, scans.pop(i))
+            break
+    return scans
+
+
+def other_axes(scans, session):
+    """Return an OrderedDict of {axis name: array of positions} for the axes other than the line scan axis.
+    Axes that aren't specified stay at their current positions."""
+    scans = list(scans)
+    scan_dirs = {scan[0] for scan in scans}
+    for direction in {'x', 'y', 'z'} - scan_dirs:
+        scans.append([direction, session.axis(direction).get_position()])
+
+    # Convert each remaining scan specification into a tuple of ('axis_name', array([val1, val2, ...]) )
+    scans = [(scan[0], hp_line_scan.arange(*scan[1:])) for scan in scans[1:]]
+
+    # Concatenate arrays together, so that "x=1,2,3 y=1 x=5,6,7" -> "x=1,2,3,5,6,7 y=1"
+    scan_dict = OrderedDict()
+    for axis_name, scan_array in scans:
+        scan_dict[axis_name] = np.concatenate([scan_dict[axis_name], scan_array]) if axis_name in scan_dict.keys() else scan_array
+    return scan_dict
+
+
+def map_scan(scans, session=None, out_file=sys.stdout, hp_range=3.0, probes=None, passes=None, std_err=None,
+             publish=None, trace=None, magnet=None, current=None, comment=None):
+    """Run a map, writing a header and then the data to out_file as CSV.
+    scans is a list of scan specifications [axis name, start[, stop[, step]]]. The first scan is done as a LineScan,
+    and repeated for each combination of positions of the others. probes is a dict of {resource name: (x, y, z) offset}.
+    Give a socket path to publish (or '' for the default) to publish each line, and a folder to trace to save a trace
+    of instrument calls. Each line is repeated up to passes times (by default once, or 10 times if std_err is given),
+    stopping once the standard error of every point is below std_err."""
+    if passes is None:
+        passes = 1 if std_err is None else 10
+    elif std_err is not None and passes < 2:
+        raise ValueError('a target standard error needs more than one pass')
+    scans = order_scans(scans)
+    session = instrument_session.InstrumentSession() if session is None else session
+
+    tracer = None
+    publisher = None
+    try:
+        if trace:
+            import scan_trace
+            tracer = scan_trace.Tracer(trace_dir=trace)
+            tracer.enable()
+
+        publisher = scan_publisher.ScanPublisher(scan_publisher.socket_address(publish)) if publish is not None else None
+
+        # several probes are triggered together and read in parallel
+        line_scan = hp_line_scan.LineScan(*scans[0], hp_range=hp_range, probes=probes, session=session)
+        scan_dict = other_axes(scans, session)
+
+        # Set up the scan
+        field_units = 'T'
+        for probe, offset in line_scan.probes:
+            probe.setUnits(field_units)
+
+        # Produce a header for the file(s)
+        header = [('Date/time', datetime.now().strftime('%d/%m/%y %H:%M:%S')),
+                  ('Magnet under test', magnet) if magnet else (),
+                  ('Magnet current [A]', current) if current else (),
+                  *[('Probe', f'{probe.probe.manufacturer_name} {probe.probe.model_name} S/N {probe.probe.serial_number}',
+                     'offset [mm]', *offset) for probe, offset in line_scan.probes],
+                  ('Averages', *[probe.getAverages() for probe, offset in line_scan.probes]),  # one for each probe
+                  ('Probe range', hp_range) if isinstance(hp_range, str)
+                  else ('Probe range', *[probe.getRange()[1] for probe, offset in line_scan.probes]),
+                  ('Comment', comment) if comment else (),
+                  ]
+
+        columns = ''
+        position_axes = []  # other axes with a column: those that vary, or where the probes are at different positions
+        for axis_name, scan_array in scan_dict.items():
+            if len(scan_array) == 1:
+                header.append((f'{axis_name} position [mm]', scan_array[0]))
+            if len(scan_array) > 1 or len({probe_offset(axis_name, offset) for probe, offset in line_scan.probes}) > 1:
+                columns += f'{axis_name} [mm],'
+                position_axes.append(axis_name)
+        columns += f'{line_scan.axis_name} [mm]'
+
+        # Write header and columns to CSV file
+        [print(*l, sep=',', file=out_file) for l in header if l]
+        field_columns = [f'{b} [{field_units}]' for b in ('Bx', 'By', 'Bz')]
+        if passes > 1:
+            field_columns += [f'std err {b} [{field_units}]' for b in ('Bx', 'By', 'Bz')]
+        print(columns, *field_columns, sep=',', file=out_file)
+
+        # we should have two or three axes to scan over (e.g. X, Y, and stroke, with a LineScan in Z)
+        assert len(scan_dict) in (2, 3)
+        start = datetime.now()
+        eta = None
+
+        axis2 = list(scan_dict)[0]
+        ax2_values = scan_dict[axis2]
+        axis3 = list(scan_dict)[1]
+        ax3_values = scan_dict[axis3]
+        if len(scan_dict) >= 3:
+            axis4 = list(scan_dict)[2]
+            ax4_values = scan_dict[axis4]
+        else:
+            axis4 = None
+            ax4_values = [0]
+
+        n_line_scans = len(ax2_values) * len(ax3_values) * len(ax4_values)
+
+        for k, s in enumerate(ax4_values):
+            if axis4 is not None:
+                print(f'{axis4} = {s} mm')
+                session.axis(axis4).move(s, wait=True)
+
+            for j, z in enumerate(ax3_values):
+                print(f'{axis3} = {z} mm')
+                session.axis(axis3).move(z, wait=True)
+
+                # Run the scan, invoking line_scan for each position along axis 2
+                for i, y in enumerate(ax2_values):
+                    if i > 0:
+                        progress = i / n_line_scans
+                        elapsed = datetime.now() - start
+                        eta = start + elapsed / progress
+                    print(f'{axis2} = {y} mm' + (eta.strftime(', ETA %H:%M') if eta else ''))
+                    session.axis(axis2).move(y, wait=True)
+                    tries = 0
+                    ok = False
+                    line_start = datetime.now()
+                    while not ok:
+                        try:
+                            if passes > 1:
+                                line_scan.runPasses(std_err, max_passes=passes, line_key=(y, z, s))
+                            else:
+                                line_scan.run(line_key=(y, z, s))
+                            ok = True
+                        except (hp_line_scan.MissedTriggerError, EncoderException) as e:  # sometimes we get a little hiccup
+                            line_scan.axis.stop()
+                            tries += 1
+                            print(e)
+                            if tries % 5 == 0 and input(f'Scan failed after {tries} tries. Try again? [Y/n]').upper() not in ('', 'Y'):
+                                raise  # break out
+                    fixed = {axis2: y, axis3: z} if axis4 is None else {axis2: y, axis3: z, axis4: s}
+                    if publisher:
+                        duration = (datetime.now() - line_start).total_seconds()
+                        publisher.publish(scan_publisher.line_message(line_scan, fixed, line_start.timestamp(), duration))
+
+                    # Record the data: one row per point for each probe, at the probe's actual position
+                    for i_probe, ((probe, offset), field_values) in enumerate(zip(line_scan.probes, line_scan.probe_field_values)):
+                        if passes > 1:
+                            field_values = np.hstack([field_values, line_scan.probe_field_std_err[i_probe]])
+                        probe_fixed = [fixed[axis_name] + probe_offset(axis_name, offset) for axis_name in position_axes]
+                        probe_x_values = line_scan.pos_values + probe_offset(line_scan.axis_name, offset)
+                        for x, field in zip(probe_x_values, field_values):
+                            print(','.join([f'{p:.5f}' for p in np.concatenate([probe_fixed, [x], field])]), file=out_file)
+
+                    # Save as we go along in case of unforeseen errors
+                    out_file.flush()
+    finally:  # even if a line fails
+        if publisher:
+            publisher.close()
+        if tracer:
+            print(tracer.summary())
+            tracer.disable()
+
+
+if __name__ == '__main__':
+    import magnet_lab
+    sys.exit(magnet_lab.main(['map'] + sys.argv[1:]))
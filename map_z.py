@@ -1,48 +1,60 @@
+"""Find the peak field along z by fitting a parabola to Bz from a LineScan.
+Run from the command line with "magnet_lab.py peak"; running this script uses the settings below."""
 import os
 import numpy as np
 import hp_line_scan
-import motor_controller
+import instrument_session
 from datetime import datetime
 
-x, y = 0, 0
-
-mc = motor_controller.MotorController()
-mc.axis['x'].move(x, wait=True)
-mc.axis['y'].move(y, wait=True)
-
-start, stop, step = 0, 40, 0.5
-line_scan = hp_line_scan.LineScan('z', start, stop, step, mc=mc)
-
-magnet = 'PITZ Compensation Solenoid'
-current = 30
-comment = 'Z scan to find peak'
-
-path = r'\\fed.cclrc.ac.uk\Org\NLab\ASTeC\Apsv4\Astec\IDs and Magnets\Data\PITZ solenoids\Compensation solenoid 15050'
-filename = os.path.join(path, '07 z scan.csv')
-file = open(filename, 'a')
-scan_time = datetime.now()
-
-line_scan.run()
-# fit 2nd-order poly to Bz values
-fit_coeffs = np.polyfit(line_scan.pos_values, line_scan.field_values[:, 2], deg=2)
-peak_pos = -fit_coeffs[1] / (2 * fit_coeffs[0])
-print(f'Found peak at {peak_pos:.3f} mm')
-
-hp = line_scan.hp
-header = ['Date/time,' + scan_time.strftime('%d/%m/%y %H:%M:%S'),
-          f'Magnet under test,{magnet}',
-          f'Magnet current [A],{current}',
-          f'Probe,{hp.probe.manufacturer_name} {hp.probe.model_name} S/N {hp.probe.serial_number}',
-          f'Averages,{hp.getAverages()}',
-          f'Probe range,{hp.getRange()[1]}',
-          f'Comment,{comment}',
-          f'X position [mm],{x}',
-          f'Y position [mm],{y}',
-          'Polynomial fit coefficients,' + ','.join([f'{c:.3g}' for c in fit_coeffs]),
-          f'Peak position [mm],{peak_pos:.3f}',
-          'Z [mm],Bx [mT],By [mT],Bz [mT]',
-          ]
-file.writelines('%s\n' % l for l in header)
-for position, field in zip(line_scan.pos_values, line_scan.field_values):
-    file.write(','.join([f'{p:.3f}' for p in np.insert(field, 0, position)]) + '\n')
-file.close()
+
+def find_peak(x=0, y=0, start=0, stop=40, step=0.5, session=None, **kwargs):
+    """Move to (x, y), scan along z and fit a 2nd-order polynomial to the Bz values.
+    Other arguments are passed to LineScan. Return the line scan, the fit coefficients and the peak position."""
+    session = instrument_session.InstrumentSession() if session is None else session
+    session.axis('x').move(x, wait=True)
+    session.axis('y').move(y, wait=True)
+
+    line_scan = hp_line_scan.LineScan('z', start, stop, step, session=session, **kwargs)
+    line_scan.run()
+    # fit 2nd-order poly to Bz values
+    fit_coeffs = np.polyfit(line_scan.pos_values, line_scan.field_values[:, 2], deg=2)
+    peak_pos = -fit_coeffs[1] / (2 * fit_coeffs[0])
+    print(f'Found peak at {peak_pos:.3f} mm')
+    return line_scan, fit_coeffs, peak_pos
+
+
+def write_peak(file, line_scan, fit_coeffs, peak_pos, x, y, scan_time, magnet=None, current=None, comment=None):
+    """Write the header, fit and data from find_peak to a file."""
+    hp = line_scan.hp
+    header = ['Date/time,' + scan_time.strftime('%d/%m/%y %H:%M:%S'),
+              f'Magnet under test,{magnet}' if magnet else '',
+              f'Magnet current [A],{current}' if current else '',
+              f'Probe,{hp.probe.manufacturer_name} {hp.probe.model_name} S/N {hp.probe.serial_number}',
+              f'Averages,{hp.getAverages()}',
+              f'Probe range,{hp.getRange()[1]}',
+              f'Comment,{comment}' if comment else '',
+              f'X position [mm],{x}',
+              f'Y position [mm],{y}',
+              'Polynomial fit coefficients,' + ','.join([f'{c:.3g}' for c in fit_coeffs]),
+              f'Peak position [mm],{peak_pos:.3f}',
+              f'Z [mm],Bx [{hp.units}],By [{hp.units}],Bz [{hp.units}]',
+              ]
+    file.writelines('%s\n' % l for l in header if l)
+    for position, field in zip(line_scan.pos_values, line_scan.field_values):
+        file.write(','.join([f'{p:.3f}' for p in np.insert(field, 0, position)]) + '\n')
+
+
+if __name__ == '__main__':
+    x, y = 0, 0
+    start, stop, step = 0, 40, 0.5
+
+    magnet = 'PITZ Compensation Solenoid'
+    current = 30
+    comment = 'Z scan to find peak'
+
+    path = r'\\fed.cclrc.ac.uk\Org\NLab\ASTeC\Apsv4\Astec\IDs and Magnets\Data\PITZ solenoids\Compensation solenoid 15050'
+    filename = os.path.join(path, '07 z scan.csv')
+    scan_time = datetime.now()
+    results = find_peak(x, y, start, stop, step)
+    with open(filename, 'a') as file:
+        write_peak(file, *results, x, y, scan_time, magnet, current, comment)
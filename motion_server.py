@@ -0,0 +1,232 @@
+"""Local server owning the motor controller serial ports, so that several scripts can share one connection.
+Requests are JSON lines sent over a Unix socket (or a localhost TCP port where there are none, e.g. on Windows);
+MotionClient mirrors the MotorController/Axis API on the client side.
+Commands from all clients are serialised per port, and axis parameters (from 'qa') are cached on the server."""
+import argparse
+import json
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+from functools import wraps
+import motor_controller
+
+unix_sockets = hasattr(socket, 'AF_UNIX')
+if unix_sockets:
+    address_family = socket.AF_UNIX
+    StreamServer = socketserver.UnixStreamServer
+    default_socket = os.path.join(tempfile.gettempdir(), 'magnet-lab-motion.sock')
+else:  # e.g. Windows
+    address_family = socket.AF_INET
+    StreamServer = socketserver.TCPServer
+    default_socket = ('localhost', 47641)
+axis_methods = ('talk', 'get_position', 'move', 'stop', 'resetPosition', 'setLimits', 'getSpeed', 'setSpeed',
+                'queryAll', 'getLimits')
+changes_parameters = ('talk', 'resetPosition', 'setLimits', 'setSpeed')  # these invalidate the parameter cache
+axis_attributes = ('id', 'scale_factor', 'max_speed', 'acceleration', 'type', 'units', 'version')
+exceptions = {'OutOfRangeException': motor_controller.OutOfRangeException, 'ValueError': ValueError,
+              'TimeoutError': TimeoutError, 'KeyError': KeyError, 'TypeError': TypeError}
+
+
+class RemoteError(Exception):
+    """Raise when the motion server reports an error that doesn't map onto a local exception type."""
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Handle the requests from one client connection, one JSON line at a time."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                reply = {'result': self.server.dispatch(request.get('axis'), request['method'],
+                                                        request.get('args', []), request.get('kwargs', {}))}
+            except Exception as e:
+                reply = {'error': type(e).__name__, 'message': str(e)}
+            self.wfile.write(json.dumps(reply, default=float).encode('utf-8') + b'\n')
+
+
+class MotionServer(socketserver.ThreadingMixIn, StreamServer):
+    """Owns a MotorController (and optionally a ZeptoDipoleController, as axis 's') and serves its axes."""
+    daemon_threads = True
+
+    def __init__(self, path=default_socket, mc=None, zepto=None, warm_cache=True):
+        self.mc = motor_controller.MotorController() if mc is None else mc
+        self.zepto = zepto
+        self.axes = dict(self.mc.axis)
+        if zepto is not None:
+            self.axes['s'] = zepto.axis
+        self.cache = {}  # Axis: result of queryAll
+        self.cache_lock = threading.Lock()
+        port_locks = {}
+        for axis in set(self.axes.values()):
+            self.serialise(axis, port_locks.setdefault(id(axis.serial_port), threading.Lock()))
+        if unix_sockets and os.path.exists(path):  # left over from a previous server
+            os.remove(path)
+        super().__init__(path, RequestHandler)
+        if warm_cache:
+            threading.Thread(target=self.warmCache, daemon=True).start()
+
+    def serialise(self, axis, lock):
+        """Make sure only one command at a time goes to the axis's serial port, and cache its parameters."""
+        @wraps(motor_controller.Axis.talk)
+        def talk(*args, **kwargs):
+            with lock:
+                return type(axis).talk(axis, *args, **kwargs)
+
+        @wraps(motor_controller.Axis.queryAll)
+        def query_all():
+            with self.cache_lock:
+                cached = self.cache.get(axis)
+            if cached is None:
+                cached = type(axis).queryAll(axis)
+                with self.cache_lock:
+                    self.cache[axis] = cached
+            return dict(cached)  # N.B. positions in here may be out of date
+        axis.talk = talk
+        axis.queryAll = query_all
+
+    def warmCache(self):
+        """Query the parameters of all the axes, so they are ready when clients ask."""
+        for axis in set(self.axes.values()):
+            try:
+                axis.queryAll()
+            except (ValueError, IndexError):  # some axes (e.g. SCL) don't support 'qa'
+                pass
+
+    def describe(self):
+        """Return the axis names and the fixed parameters of each axis."""
+        return {name: {attribute: getattr(axis, attribute) for attribute in axis_attributes}
+                for name, axis in self.axes.items()}
+
+    def dispatch(self, axis_name, method, args, kwargs):
+        """Call a method on one of the axes, or on the server itself if axis_name is None."""
+        if axis_name is None:
+            if method not in ('describe', 'ping'):
+                raise ValueError(f'unknown server method "{method}"')
+            return self.describe() if method == 'describe' else 'pong'
+        if method not in axis_methods:
+            raise ValueError(f'unknown axis method "{method}"')
+        axis = self.axes[axis_name]
+        result = getattr(axis, method)(*args, **kwargs)
+        if method in changes_parameters:
+            with self.cache_lock:
+                self.cache.pop(axis, None)
+        return result
+
+    def server_close(self):
+        super().server_close()
+        if unix_sockets and os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class RemoteAxis:
+    """Stands in for a motor_controller.Axis, passing method calls on to the motion server."""
+
+    def __init__(self, client, name, **attributes):
+        self.client = client
+        self.name = name
+        for attribute, value in attributes.items():
+            setattr(self, attribute, value)
+
+    def call(self, method, *args, **kwargs):
+        return self.client.call(self.name, method, *args, **kwargs)
+
+    def talk(self, command, parameter='', multi_line=False, check_ok=False, poll_interval=None):
+        return self.call('talk', command, parameter, multi_line=multi_line, check_ok=check_ok,
+                         poll_interval=poll_interval)
+
+    def get_position(self, set_value=True, poll_interval=None):
+        return self.call('get_position', set_value, poll_interval=poll_interval)
+
+    def move(self, position, relative=False, wait=False, tolerance=0.01, timeout='auto'):
+        return self.call('move', position, relative=relative, wait=wait, tolerance=tolerance, timeout=timeout)
+
+    def stop(self):
+        return self.call('stop')
+
+    def resetPosition(self, position=0):
+        return self.call('resetPosition', position)
+
+    def setLimits(self, limits=None):
+        return self.call('setLimits', limits)
+
+    def getSpeed(self):
+        return self.call('getSpeed')
+
+    def setSpeed(self, speed=None):
+        return self.call('setSpeed', speed)
+
+    def queryAll(self):
+        return self.call('queryAll')
+
+    def getLimits(self):
+        limits = self.call('getLimits')
+        return None if limits is None else tuple(limits)
+
+
+class MotionClient:
+    """Stands in for a MotorController, using the axes of a running motion server.
+    Each client has its own connection; calls from different threads on the same client are serialised."""
+
+    def __init__(self, path=default_socket):
+        self.file = None
+        self.socket = socket.socket(address_family, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.file = self.socket.makefile('rwb')
+        self.lock = threading.Lock()
+        self.axis = {name: RemoteAxis(self, name, **attributes)
+                     for name, attributes in self.call(None, 'describe').items()}
+
+    def call(self, axis_name, method, *args, **kwargs):
+        """Call a method on the server and return the result, raising any error it reports."""
+        request = {'axis': axis_name, 'method': method, 'args': args, 'kwargs': kwargs}
+        with self.lock:
+            self.file.write(json.dumps(request, default=float).encode('utf-8') + b'\n')
+            self.file.flush()
+            reply = json.loads(self.file.readline())
+        if 'error' in reply:
+            raise exceptions.get(reply['error'], RemoteError)(reply['message'])
+        return reply['result']
+
+    def close(self):
+        """Close the connection to the server - the serial port stays open."""
+        if self.file is not None:
+            self.file.close()
+        self.socket.close()
+
+    def __del__(self):
+        self.close()
+
+
+def connect(path=default_socket):
+    """Return a client for the motion server if it is running, otherwise open the motor controller directly."""
+    try:
+        return MotionClient(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return motor_controller.MotorController()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the motor controller axes to local clients.')
+    parser.add_argument('--socket', default=default_socket,
+                        help='path of the Unix socket to listen on (or the localhost port, where there are none)')
+    parser.add_argument('--zepto', action='store_true', help='also open the ZEPTO dipole controller, as axis "s"')
+    parser.add_argument('--simulate', action='store_true', help='serve simulated controllers instead')
+    args = parser.parse_args()
+    if not unix_sockets and isinstance(args.socket, str):
+        args.socket = ('localhost', int(args.socket))
+    if args.simulate:
+        import sim_motor_controller
+        mc = sim_motor_controller.SimulatedMotorController()
+        zepto = sim_motor_controller.SimulatedZeptoDipoleController() if args.zepto else None
+    else:
+        mc = motor_controller.MotorController()
+        zepto = motor_controller.ZeptoDipoleController() if args.zepto else None
+    with MotionServer(args.socket, mc, zepto) as server:
+        print(f'Serving {len(server.axes)} axes on {args.socket}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -36,10 +36,12 @@ class Axis:
             self.prefix = '{:02d}{}'.format(self.id, '#' if version == 'PM341' else ':')
         self.line_end = b'\r' if version == 'SCL' else b'\r\n'
         self.echo = version != 'SCL'
+        self.poll_interval = 0.2  # how often to check for a reply - can be reduced for fast position reads
 
     def talk(self, command: str, parameter: Union[str, int, float] = '',
-             multi_line: bool = False, check_ok: bool = False):
-        """Send a command to the motor controller and wait for a response."""
+             multi_line: bool = False, check_ok: bool = False, poll_interval: float = None):
+        """Send a command to the motor controller and wait for a response, checking for it every poll_interval
+        seconds (by default, the axis's poll_interval)."""
         command = command.upper()  # need upper for SCL, other versions don't care
         # Coerce floats to ints (assuming there aren't any float-type commands!)
         if isinstance(parameter, float):
@@ -48,7 +50,10 @@ class Axis:
         self.serial_port.write(send.encode('utf-8') + self.line_end)
         reply = ''
         while reply.count(self.line_end.decode('utf-8')) < (2 if self.echo else 1):
-            sleep(2 if command.lower() in ('qa', 'he', 'hc') else 0.2)  # longer for certain commands
+            if command.lower() in ('qa', 'he', 'hc'):  # longer for certain commands
+                sleep(2)
+            else:
+                sleep(self.poll_interval if poll_interval is None else poll_interval)
             reply += self.serial_port.read_all().decode('utf-8')
         lines = reply.splitlines()
         if self.echo:
@@ -60,13 +65,13 @@ class Axis:
             raise ValueError('Error response on command "{}": received "{}"'.format(send, lines[0]))
         return lines if multi_line else lines[0]
 
-    def get_position(self, set_value=True):  # ask for the set value by default, otherwise the read value
-        """Query the motor controller for the axis position (set or read)."""
+    def get_position(self, set_value=True, poll_interval=None):  # ask for the set value by default, else read value
+        """Query the motor controller for the axis position (set or read). Give a short poll_interval for fast reads."""
         if self.version == 'SCL':
             command = 'ie'  # TODO: set position?
         else:
             command = 'oc' if set_value else 'oa'  # "output command", "output actual"
-        reply = self.talk(command)  # "output command", "output actual"
+        reply = self.talk(command, poll_interval=poll_interval)  # "output command", "output actual"
         # reply should begin either CP=, AP= or 01#, 02#, ...
         if self.version == 'PM304':
             prefix = 'CP=' if set_value else 'AP='
@@ -180,13 +185,15 @@ class Axis:
 
 
 class MotorController:
-    def __init__(self):
-        serial_port = serial.Serial()
+    port_name = 'COM1'
+    bytesize = 7
+    parity = serial.PARITY_EVEN
+
+    def __init__(self, serial_port=None):
+        """Set up the axes. Supply an open serial port (or something that behaves like one) to avoid opening COM1."""
+        if serial_port is None:
+            serial_port = self.openPort()
         self.serial_port = serial_port
-        serial_port.port = 'COM1'
-        serial_port.bytesize = 7
-        serial_port.parity = serial.PARITY_EVEN
-        serial_port.open()
 
         hpx = Axis(serial_port, 2, 2000, 2, 0.5)
         hpy = Axis(serial_port, 1, 2000, 6, 0.75)
@@ -204,22 +211,34 @@ class MotorController:
                      'px': Axis(serial_port, 11, 1000, 6, 6, version='PM600'),
                      'fc z2': Axis(serial_port, 12, 1000, 6, 2, version='PM600')}
 
+    @classmethod
+    def openPort(cls):
+        """Open the serial port used by this controller."""
+        serial_port = serial.Serial()
+        serial_port.port = cls.port_name
+        serial_port.bytesize = cls.bytesize
+        serial_port.parity = cls.parity
+        serial_port.open()
+        return serial_port
+
     def close(self):
         """Close the serial port - we're finished with it."""
         self.serial_port.close()
 
     def __del__(self):
-        self.close()
+        if hasattr(self, 'serial_port'):  # not if opening the port failed
+            self.close()
 
 
 class ZeptoDipoleController(MotorController):
-    def __init__(self):
-        serial_port = serial.Serial()
+    port_name = 'COM8'
+    bytesize = 8
+    parity = serial.PARITY_NONE
+
+    def __init__(self, serial_port=None):
+        if serial_port is None:
+            serial_port = self.openPort()
         self.serial_port = serial_port
-        serial_port.port = 'COM8'
-        serial_port.bytesize = 8
-        serial_port.parity = serial.PARITY_NONE
-        serial_port.open()
 
         # speed is 2 rev/s (VE command)
         # accel is 50 rev/s/s (AC command)
@@ -0,0 +1,215 @@
+"""End-to-end scan throughput benchmarks, run against simulated hardware.
+Results are appended to a JSON history file, and compared with the previous run to catch regressions."""
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import subprocess
+from collections import defaultdict
+from datetime import datetime
+from functools import wraps
+from time import perf_counter
+import hp_line_scan
+import instrument_session
+import sim_motor_controller
+import sim_hall_probe
+import sim_adlink_card
+
+
+class TimeSplit:
+    """Accumulate the time spent in instrument calls, by category. Time in nested calls is only counted against the
+    innermost category, so e.g. the serial I/O done while waiting for a move to finish counts as I/O, not motion."""
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.stack = []  # list of [category, time in nested calls]
+
+    def wrap(self, obj, method_name, category):
+        """Replace a method on an object with one that records the time spent in it."""
+        method = getattr(obj, method_name)
+
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            self.stack.append([category, 0.0])
+            start = perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - start
+                nested = self.stack.pop()[1]
+                self.totals[category] += elapsed - nested
+                if self.stack:
+                    self.stack[-1][1] += elapsed
+        setattr(obj, method_name, wrapper)
+
+    def split(self, total):
+        """Return a dict of time per category, including 'other' for time outside instrument calls."""
+        split = dict(self.totals)
+        split['other'] = total - sum(split.values())
+        return {category: round(t, 4) for category, t in split.items()}
+
+
+class SimulatedRig:
+    """Simulated motor controller, Hall probe, encoder card and (optionally) ZEPTO stroke drive,
+    with timing instrumented by a TimeSplit."""
+
+    def __init__(self, serial_latency=0.02, probe_latency=0.002, card_links=None, zepto=False, field_model=None):
+        self.mc = sim_motor_controller.SimulatedMotorController(latency=serial_latency)
+        self.zepto = sim_motor_controller.SimulatedZeptoDipoleController(latency=serial_latency) if zepto else None
+        field_model = field_model or sim_hall_probe.SolenoidField(b0=0.05, length=20, radius=10, centre=(0, 0, 2.5))
+        self.hp = sim_hall_probe.SimulatedMetrolabProbe(field_model, sim_hall_probe.stage_position(self.mc),
+                                                        latency=probe_latency, seed=0)
+        self.card = sim_adlink_card.SimulatedAdlinkCard(self.mc, links=card_links, seed=0)
+        self.session = instrument_session.InstrumentSession(self.mc, self.hp, self.card, self.zepto)
+        self.time_split = TimeSplit()
+        axes = set(self.mc.axis.values()) | ({self.zepto.axis} if zepto else set())
+        for axis in axes:
+            self.time_split.wrap(axis, 'talk', 'io')
+            self.time_split.wrap(axis, 'move', 'motion')
+        for method_name in ('query', 'write', 'assert_trigger'):
+            self.time_split.wrap(self.hp.probe, method_name, 'io')
+        for enc_axis in self.card.axis.values():
+            self.time_split.wrap(enc_axis, 'waitForInterrupt', 'wait')
+
+    def roundTrips(self):
+        """Return the number of serial commands sent so far."""
+        return self.mc.serial_port.write_count + (self.zepto.serial_port.write_count if self.zepto else 0)
+
+    def lineScan(self, axis_name, start, stop, step, **kwargs):
+        return hp_line_scan.LineScan(axis_name, start, stop, step, session=self.session, **kwargs)
+
+
+def line_benchmark(rig, line_scan, n_lines):
+    """Run the same line scan repeatedly."""
+    for _ in range(n_lines):
+        line_scan.run()
+    return n_lines * line_scan.n_steps, n_lines
+
+
+def map_benchmark(rig, line_scan, outer_axes):
+    """Run a map in the same way as map_xy: step through the outer axes (a list of (axis name, values) from the
+    outermost in), moving each one when its value changes, and run the line scan at each position."""
+    innermost = outer_axes[-1][0]
+    positions = {}
+    n_lines = 0
+    for values in itertools.product(*[axis_values for _, axis_values in outer_axes]):
+        for (axis_name, _), value in zip(outer_axes, values):
+            if axis_name == innermost or positions.get(axis_name) != value:
+                rig.mc.axis[axis_name].move(value, wait=True)
+                positions[axis_name] = value
+        line_scan.run()
+        n_lines += 1
+    return n_lines * line_scan.n_steps, n_lines
+
+
+def stroke_benchmark(rig, strokes):
+    """Step the ZEPTO dipole stroke and take a reading at each point, as in zepto_field_vs_stroke."""
+    dipole_axis = rig.zepto.axis
+    for stroke in strokes:
+        dipole_axis.move(stroke, wait=True, timeout=1000)
+        rig.hp.getField()
+    return len(strokes), 1
+
+
+def benchmarks(quick=False):
+    """Return a dict of benchmark name: function(rig) -> (points, lines), and the rig settings to use."""
+    n = 1 if quick else 3  # repeats / size of outer axes
+    stop = 2 if quick else 5
+    return {
+        'line on-the-fly': ({}, lambda rig: line_benchmark(rig, rig.lineScan('z', 0, stop, 0.5), n)),
+        'line on-the-fly x': ({}, lambda rig: line_benchmark(rig, rig.lineScan('x', 0, stop, 0.5), n)),
+        'line point-by-point': ({}, lambda rig: line_benchmark(rig, rig.lineScan('y', 0, stop, 0.5), n)),
+        'line software on-the-fly': ({}, lambda rig: line_benchmark(rig, rig.lineScan('y', 0, stop, 0.5,
+                                                                                       software_on_the_fly=True), n)),
+        'map 2d': ({}, lambda rig: map_benchmark(rig, rig.lineScan('z', 0, stop, 0.5),
+                                                 [('y', [0]), ('x', hp_line_scan.arange(0, n - 1, 1))])),
+        'map 3d': ({}, lambda rig: map_benchmark(rig, rig.lineScan('z', 0, stop, 0.5),
+                                                 [('y', [0, 0.5]), ('x', hp_line_scan.arange(0, n - 1, 1))])),
+        'stroke': ({'zepto': True}, lambda rig: stroke_benchmark(rig, hp_line_scan.arange(0, stop / 4, 0.1))),
+        'stroke on-the-fly': ({'zepto': True}, lambda rig: line_benchmark(rig, rig.lineScan('s', 0, stop / 4, 0.1,
+                                                                                          software_on_the_fly=True), 1)),
+    }
+
+
+def run_benchmark(name, settings, func, serial_latency=0.02, probe_latency=0.002):
+    """Run one benchmark on a fresh simulated rig and return a dict of results."""
+    rig = SimulatedRig(serial_latency, probe_latency, **settings)
+    rig.time_split.totals.clear()  # don't count setup
+    round_trips = rig.roundTrips()
+    start = perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):  # scans are chatty
+        points, lines = func(rig)
+    total = perf_counter() - start
+    return {'benchmark': name,
+            'points': points,
+            'lines': lines,
+            'seconds': round(total, 3),
+            'points per second': round(points / total, 4),
+            'seconds per line': round(total / lines, 3),
+            'round trips per point': round((rig.roundTrips() - round_trips) / points, 2),
+            'time split': rig.time_split.split(total)}
+
+
+def git_commit():
+    """Return the current commit hash, if there is one."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, history, quick=False, tolerance=0.1):
+    """Compare results with the most recent comparable run in the history. Return a list of regression messages."""
+    runs = [run for run in history if run['quick'] == quick]
+    if not runs:
+        return []
+    previous = {result['benchmark']: result for result in runs[-1]['results']}
+    regressions = []
+    for result in results:
+        old = previous.get(result['benchmark'])
+        if old and result['points per second'] < old['points per second'] * (1 - tolerance):
+            regressions.append(f"{result['benchmark']}: {result['points per second']:.3f} points/s, "
+                               f"was {old['points per second']:.3f}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark scan throughput against simulated hardware.')
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all)')
+    parser.add_argument('-q', '--quick', action='store_true', help='run smaller scans')
+    parser.add_argument('-o', '--output', default='bench_history.json', help='JSON history file to append results to')
+    parser.add_argument('--serial-latency', type=float, default=0.02, help='motor controller reply latency [s]')
+    parser.add_argument('--probe-latency', type=float, default=0.002, help='Hall probe round trip time [s]')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='fractional slowdown compared to the last run that counts as a regression')
+    args = parser.parse_args(argv)
+
+    suite = benchmarks(args.quick)
+    names = args.names or list(suite)
+    results = []
+    for name in names:
+        settings, func = suite[name]
+        result = run_benchmark(name, settings, func, args.serial_latency, args.probe_latency)
+        split = ', '.join(f'{category} {t:.2f}s' for category, t in result['time split'].items())
+        print(f"{name}: {result['points per second']:.3f} points/s, {result['seconds per line']:.2f} s/line, "
+              f"{result['round trips per point']:.1f} round trips/point ({split})")
+        results.append(result)
+
+    history = []
+    if os.path.exists(args.output):
+        with open(args.output) as history_file:
+            history = json.load(history_file)
+    regressions = compare(results, history, args.quick, args.tolerance)
+    for regression in regressions:
+        print('Regression:', regression)
+    history.append({'date': datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(), 'quick': args.quick,
+                    'results': results})
+    with open(args.output, 'w') as history_file:
+        json.dump(history, history_file, indent=1)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,168 @@
+"""Publish each completed scan line over a local socket, so that maps can be watched live without slowing them down.
+Messages are JSON lines; ScanSubscriber reads them and LiveGrid keeps the map so far in memory."""
+import argparse
+import json
+import os
+import queue
+import socket
+import tempfile
+import threading
+import numpy as np
+
+unix_sockets = hasattr(socket, 'AF_UNIX')  # as motion_server
+if unix_sockets:
+    address_family = socket.AF_UNIX
+    default_socket = os.path.join(tempfile.gettempdir(), 'magnet-lab-scan.sock')
+else:  # e.g. Windows
+    address_family = socket.AF_INET
+    default_socket = ('localhost', 47642)
+
+
+def socket_address(name=None):
+    """Return the address to publish on, given a socket path (or a port number where there are no Unix sockets)."""
+    if not name:
+        return default_socket
+    return name if unix_sockets else ('localhost', int(name))
+
+
+def line_message(line_scan, fixed_positions, start_time, duration):
+    """Return a message describing a completed line scan, with the positions of the other axes and the timing."""
+    field = np.asarray(line_scan.field_values)
+    return {'axis': line_scan.axis_name,
+            'positions': np.asarray(line_scan.pos_values).tolist(),
+            'fixed': {axis_name: float(value) for axis_name, value in fixed_positions.items()},
+            'Bx': field[:, 0].tolist(), 'By': field[:, 1].tolist(), 'Bz': field[:, 2].tolist(),
+            'start': start_time, 'duration': duration}
+
+
+class ScanPublisher:
+    """Accept subscribers on a Unix socket (or a localhost TCP port where there are none), and send each published message to all of them.
+    Publishing never blocks: each subscriber has a bounded queue, and messages are dropped for any that fall behind."""
+
+    def __init__(self, path=default_socket, queue_size=100):
+        self.path = path
+        self.queue_size = queue_size
+        self.subscribers = []  # list of queues
+        self.lock = threading.Lock()
+        self.dropped = 0  # messages not delivered to slow subscribers
+        if unix_sockets and os.path.exists(path):  # left over from a previous publisher
+            os.remove(path)
+        self.socket = socket.socket(address_family, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        self.socket.listen()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        """Wait for subscribers to connect, and start a sender thread for each one."""
+        while True:
+            try:
+                connection, _ = self.socket.accept()
+            except OSError:  # socket closed
+                return
+            messages = queue.Queue(self.queue_size)
+            with self.lock:
+                self.subscribers.append(messages)
+            threading.Thread(target=self.send, args=(connection, messages), daemon=True).start()
+
+    def send(self, connection, messages):
+        """Send queued messages to one subscriber until it disconnects (or None is queued)."""
+        with connection:
+            while (data := messages.get()) is not None:
+                try:
+                    connection.sendall(data)
+                except OSError:  # subscriber has gone away
+                    break
+        with self.lock:
+            self.subscribers.remove(messages)
+
+    def publish(self, message):
+        """Queue a message (anything JSON-serialisable) for all subscribers."""
+        data = json.dumps(message).encode('utf-8') + b'\n'
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for messages in subscribers:
+            try:
+                messages.put_nowait(data)
+            except queue.Full:
+                self.dropped += 1
+
+    def close(self):
+        """Stop accepting subscribers and disconnect the existing ones once their queues are sent."""
+        self.socket.close()
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for messages in subscribers:
+            try:
+                messages.put_nowait(None)
+            except queue.Full:
+                pass
+        if unix_sockets and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class LiveGrid:
+    """Keeps the lines received so far in memory, keyed by the positions of the other axes."""
+
+    def __init__(self):
+        self.lines = {}  # tuple of (axis name, value) pairs: (positions, field array of shape (n, 3))
+        self.scan_axis = None
+        self.scan_time = 0.0
+
+    def update(self, message):
+        """Add (or replace) a line."""
+        key = tuple(sorted(message['fixed'].items()))
+        self.lines[key] = (np.array(message['positions']), np.transpose([message['Bx'], message['By'], message['Bz']]))
+        self.scan_axis = message['axis']
+        self.scan_time += message['duration']
+
+    def grid(self):
+        """Return the fixed positions of each line, the scan positions (from the first line) and an array of field
+        values of shape (lines, points, 3), with NaN where a line is shorter than the first one."""
+        keys = sorted(self.lines)
+        if not keys:
+            return keys, np.array([]), np.zeros((0, 0, 3))
+        positions = self.lines[keys[0]][0]
+        field = np.full((len(keys), len(positions), 3), np.nan)
+        for i, key in enumerate(keys):
+            line_field = self.lines[key][1][:len(positions)]
+            field[i, :len(line_field)] = line_field
+        return keys, positions, field
+
+
+class ScanSubscriber:
+    """Connect to a ScanPublisher and read the messages it sends."""
+
+    def __init__(self, path=default_socket):
+        self.socket = socket.socket(address_family, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.file = self.socket.makefile('rb')
+
+    def __iter__(self):
+        for line in self.file:
+            yield json.loads(line)
+
+    def follow(self, grid, callback=None):
+        """Update a LiveGrid with each message as it arrives, calling callback(message) afterwards."""
+        for message in self:
+            grid.update(message)
+            if callback is not None:
+                callback(message)
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Watch a scan in progress.')
+    parser.add_argument('--socket', type=socket_address, default=default_socket,
+                        help='path of the socket the scan is publishing on (or the localhost port, where there are none)')
+    args = parser.parse_args()
+    live_grid = LiveGrid()
+
+    def show(message):
+        fixed = ', '.join(f'{axis_name} = {value:g} mm' for axis_name, value in message['fixed'].items())
+        b_max = np.max(np.abs([message['Bx'], message['By'], message['Bz']]))
+        print(f"{len(live_grid.lines)} lines: {fixed}, {len(message['positions'])} points along {message['axis']}, "
+              f"max |B| {b_max:.5g}, {message['duration']:.1f} s")
+    ScanSubscriber(args.socket).follow(live_grid, show)
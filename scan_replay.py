@@ -0,0 +1,429 @@
+"""Record the I/O of the instruments during scans to a compact binary log, and replay it later without the hardware.
+Recorder captures every serial write and read of the motor controllers, every query, write and trigger of the Hall
+probes, and every _8102_* call to the encoder card, with timestamps. Replay feeds them back to the same code, either
+in real time or as fast as possible, and raises ReplayMismatch if the code asks for something different.
+Like the tracer, nothing is patched until enable() is called."""
+import ctypes
+import inspect
+import json
+import struct
+import threading
+from collections import defaultdict, deque
+from functools import wraps
+from time import perf_counter, sleep
+import motor_controller
+import hall_probe
+import adlink_card
+
+magic = b'MLREC2\n'
+record_header = struct.Struct('<dBBI')  # time, channel, operation, payload length
+operations = ('channel', 'open', 'write', 'read_all', 'read', 'query', 'assert_trigger', 'call')
+functions = ('_8102_initial', '_8102_config_from_file', '_8102_set_position', '_8102_get_position',
+             '_8102_set_motion_int_factor', '_8102_set_trigger_comparator', '_8102_wait_motion_interrupt',
+             '_8102_int_control')
+pointer_types = (ctypes.c_uint16, ctypes.c_double)  # arguments that the card writes values to
+resource_attributes = ('manufacturer_name', 'model_name', 'serial_number')
+
+
+class ReplayMismatch(Exception):
+    """Raise when the code being replayed does something different from the recording."""
+
+
+class StatusCode(int):
+    """Stand-in for the pyvisa StatusCode returned by a write."""
+
+    @property
+    def value(self):
+        return int(self)
+
+
+def pack_call(name, args, error=None):
+    """Pack the function, the argument values (after the call, for pointer arguments) and any EncoderException's
+    error code and message."""
+    values = [float(arg.value if isinstance(arg, pointer_types) else arg) for arg in args]
+    code, message = (0, '') if error is None else (error.code or 0, str(error))
+    header = struct.pack('<BBi', functions.index(name), len(values), code)
+    return header + struct.pack(f'<{len(values)}d', *values) + message.encode('utf-8')
+
+
+def unpack_call(payload):
+    index, n, code = struct.unpack_from('<BBi', payload)
+    values = struct.unpack_from(f'<{n}d', payload, 6)
+    return functions[index], values, code, payload[6 + 8 * n:].decode('utf-8')
+
+
+class RecordingSerial:
+    """Wraps a serial port, recording what is written and read."""
+
+    def __init__(self, port, recorder, name):
+        self.port = port
+        self.recorder = recorder
+        self.channel = recorder.channel(name)
+
+    def write(self, data):
+        self.recorder.record(self.channel, 'write', bytes(data))
+        return self.port.write(data)
+
+    def read_all(self):
+        data = self.port.read_all()
+        self.recorder.record(self.channel, 'read_all', data)
+        return data
+
+    def read(self, size=1):
+        data = self.port.read(size)
+        self.recorder.record(self.channel, 'read', data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+
+class RecordingResource:
+    """Wraps a VISA resource, recording writes, queries and triggers."""
+
+    def __init__(self, resource, recorder, name):
+        object.__setattr__(self, 'resource', resource)
+        object.__setattr__(self, 'recorder', recorder)
+        object.__setattr__(self, 'channel', recorder.channel(name))
+        attributes = {attribute: getattr(resource, attribute) for attribute in resource_attributes}
+        recorder.record(self.channel, 'open', json.dumps(attributes).encode('utf-8'))
+
+    def write(self, message):
+        n_bytes, status = self.resource.write(message)
+        self.recorder.record(self.channel, 'write', struct.pack('<i', status.value) + message.encode('utf-8'))
+        return n_bytes, status
+
+    def query(self, message):
+        reply = self.resource.query(message)
+        self.recorder.record(self.channel, 'query', f'{message}\0{reply}'.encode('utf-8'))
+        return reply
+
+    def assert_trigger(self):
+        self.resource.assert_trigger()
+        self.recorder.record(self.channel, 'assert_trigger')
+
+    def __getattr__(self, name):
+        return getattr(self.resource, name)
+
+    def __setattr__(self, name, value):  # e.g. timeout
+        setattr(self.resource, name, value)
+
+
+class RecordingResourceManager:
+    """Wraps a VISA resource manager, so that the resources it opens are recorded."""
+
+    def __init__(self, resource_manager, recorder):
+        self.resource_manager = resource_manager
+        self.recorder = recorder
+
+    def open_resource(self, resource_name, **kwargs):
+        resource = self.resource_manager.open_resource(resource_name, **kwargs)
+        return RecordingResource(resource, self.recorder, f'visa:{resource_name}')
+
+    def __getattr__(self, name):
+        return getattr(self.resource_manager, name)
+
+
+class RecordingBackend:
+    """Wraps an encoder card backend, recording every _8102_* call."""
+
+    def __init__(self, backend, recorder):
+        self.backend = backend
+        self.recorder = recorder
+        self.channel = recorder.channel('adlink')
+
+    def __getattr__(self, name):
+        func = getattr(self.backend, name)
+        if not name.startswith('_8102_'):
+            return func
+        recorder = self.recorder
+        channel = self.channel
+
+        @wraps(func)
+        def recorded(*args):
+            try:
+                result = func(*args)
+            except adlink_card.EncoderException as e:
+                recorder.record(channel, 'call', pack_call(name, args, e))
+                raise
+            recorder.record(channel, 'call', pack_call(name, args))
+            return result
+        setattr(self, name, recorded)  # cache it, so __getattr__ isn't called again
+        return recorded
+
+
+class Patcher:
+    """Replaces the constructors of the instrument classes, restoring them on disable()."""
+
+    def __init__(self):
+        self.patches = []  # (owner, attribute name, original)
+
+    def patch(self, owner, attribute, replacement):
+        self.patches.append((owner, attribute, owner.__dict__[attribute]))
+        setattr(owner, attribute, replacement)
+
+    def disable(self):
+        """Restore the original methods."""
+        for owner, attribute, original in reversed(self.patches):
+            setattr(owner, attribute, original)
+        self.patches = []
+
+
+class Recorder(Patcher):
+    """Records instrument I/O to a binary log file. Once enabled, every motor controller, Hall probe and encoder card
+    created (simulated ones included) is recorded."""
+
+    def __init__(self, path):
+        super().__init__()
+        self.file = open(path, 'wb')
+        self.file.write(magic)
+        self.lock = threading.Lock()
+        self.channels = {}  # name: channel number
+        self.t0 = perf_counter()
+
+    def channel(self, name):
+        """Return the channel number for an instrument, declaring it in the log the first time."""
+        with self.lock:
+            if name not in self.channels:
+                self.channels[name] = len(self.channels)
+                self.write(self.channels[name], 'channel', name.encode('utf-8'))
+            return self.channels[name]
+
+    def write(self, channel, operation, payload=b''):
+        self.file.write(record_header.pack(perf_counter() - self.t0, channel, operations.index(operation), len(payload))
+                        + payload)
+
+    def record(self, channel, operation, payload=b''):
+        with self.lock:
+            self.write(channel, operation, payload)
+
+    def enable(self):
+        """Start recording."""
+        if self.patches:
+            return
+        recorder = self
+        for controller in (motor_controller.MotorController, motor_controller.ZeptoDipoleController):
+            def controller_init(mc, serial_port=None, original=controller.__init__):
+                if serial_port is None:
+                    serial_port = type(mc).openPort()
+                original(mc, RecordingSerial(serial_port, recorder, f'serial:{type(mc).port_name}'))
+            self.patch(controller, '__init__', controller_init)
+        probe_init = hall_probe.MetrolabProbe.__init__
+        default_name = inspect.signature(probe_init).parameters['resource_name'].default
+
+        def recorded_probe_init(probe, resource_name=default_name, resource_manager=None):
+            if resource_manager is None:
+                import visa
+                resource_manager = visa.ResourceManager()
+            probe_init(probe, resource_name, RecordingResourceManager(resource_manager, recorder))
+        self.patch(hall_probe.MetrolabProbe, '__init__', recorded_probe_init)
+        card_init = adlink_card.AdlinkCard.__init__
+
+        def recorded_card_init(card, backend=None):
+            card_init(card, RecordingBackend(adlink_card.DllBackend() if backend is None else backend, recorder))
+        self.patch(adlink_card.AdlinkCard, '__init__', recorded_card_init)
+
+    def close(self):
+        """Stop recording and close the log."""
+        self.disable()
+        with self.lock:
+            self.file.close()
+
+
+def read_log(path):
+    """Return the records in a log as a list of (time, channel name, operation, payload)."""
+    with open(path, 'rb') as file:
+        data = file.read()
+    if not data.startswith(magic):
+        raise ValueError(f'{path} is not an instrument log')
+    offset = len(magic)
+    channels = {}
+    records = []
+    while offset + record_header.size <= len(data):
+        t, channel, operation, length = record_header.unpack_from(data, offset)
+        offset += record_header.size
+        payload = data[offset:offset + length]
+        offset += length
+        if operations[operation] == 'channel':
+            channels[channel] = payload.decode('utf-8')
+        else:
+            records.append((t, channels[channel], operations[operation], payload))
+    return records
+
+
+class ReplaySerial:
+    """Serial port that checks what is written against a log, and returns what was read."""
+
+    def __init__(self, replay, name):
+        self.replay = replay
+        self.name = name
+        self.is_open = True
+
+    def write(self, data):
+        recorded = self.replay.take(self.name, 'write')
+        if recorded != bytes(data):
+            raise ReplayMismatch(f'{self.name}: wrote {bytes(data)!r}, recording has {recorded!r}')
+        return len(data)
+
+    def read_all(self):
+        return self.replay.take(self.name, 'read_all')
+
+    def read(self, size=1):
+        return self.replay.take(self.name, 'read')
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+
+class ReplayResource:
+    """VISA resource that checks writes and queries against a log, and returns the recorded replies."""
+
+    def __init__(self, replay, name):
+        self.replay = replay
+        self.name = name
+        self.timeout = 2000
+        self.read_termination = '\n'
+        for attribute, value in json.loads(replay.take(name, 'open')).items():
+            setattr(self, attribute, value)
+
+    def write(self, message):
+        payload = self.replay.take(self.name, 'write')
+        recorded = payload[4:].decode('utf-8')
+        if recorded != message:
+            raise ReplayMismatch(f'{self.name}: wrote "{message}", recording has "{recorded}"')
+        return len(message), StatusCode(struct.unpack_from('<i', payload)[0])
+
+    def query(self, message):
+        recorded, reply = self.replay.take(self.name, 'query').decode('utf-8').split('\0')
+        if recorded != message:
+            raise ReplayMismatch(f'{self.name}: queried "{message}", recording has "{recorded}"')
+        return reply
+
+    def assert_trigger(self):
+        self.replay.take(self.name, 'assert_trigger')
+
+    def close(self):
+        pass
+
+
+class ReplayResourceManager:
+    """Hands out ReplayResources. If the log has only one probe, it is used whatever resource name is asked for."""
+
+    def __init__(self, replay):
+        self.replay = replay
+
+    def list_resources(self):
+        return tuple(name[len('visa:'):] for name in self.replay.channels if name.startswith('visa:'))
+
+    def open_resource(self, resource_name, **kwargs):
+        names = self.list_resources()
+        if resource_name not in names and len(names) == 1:
+            resource_name = names[0]
+        return ReplayResource(self.replay, f'visa:{resource_name}')
+
+
+class ReplayBackend:
+    """Encoder card backend that checks each _8102_* call against a log, filling in the recorded values of pointer
+    arguments and raising the recorded errors."""
+
+    def __init__(self, replay):
+        self.replay = replay
+
+    def __getattr__(self, name):
+        if name not in functions:
+            raise AttributeError(name)
+        replay = self.replay
+
+        def replayed(*args):
+            recorded_name, values, code, error = unpack_call(replay.take('adlink', 'call', functions.index(name)))
+            for i, (arg, value) in enumerate(zip(args, values)):
+                if isinstance(arg, pointer_types):  # return the recorded value
+                    arg.value = type(arg.value)(value)
+                elif float(arg) != value:
+                    raise ReplayMismatch(f'{name}: argument {i} is {arg}, recording has {value}')
+            if error:
+                raise adlink_card.EncoderException(error, code or None)
+            return 0
+        replayed.__name__ = name
+        setattr(self, name, replayed)  # cache it, so __getattr__ isn't called again
+        return replayed
+
+
+class Replay(Patcher):
+    """Replays a log recorded by Recorder. Once enabled, motor controllers, Hall probes and encoder cards that would
+    open the hardware use the log instead. In real time, each reply is held back until the time it came in the
+    recording (relative to the first one); otherwise replies come straight away, and the motor controller's polling
+    delays are skipped."""
+
+    def __init__(self, path, real_time=False):
+        super().__init__()
+        self.real_time = real_time
+        self.queues = defaultdict(deque)  # (channel name, operation, function): deque of (time, payload)
+        self.channels = []
+        for t, channel, operation, payload in read_log(path):
+            key = payload[0] if operation == 'call' else None
+            self.queues[channel, operation, key].append((t, payload))
+            if channel not in self.channels:
+                self.channels.append(channel)
+        self.lock = threading.Lock()
+        self.start = None  # perf_counter() corresponding to time zero in the recording
+
+    def take(self, channel, operation, key=None):
+        """Return the payload of the next record of the given type, waiting until its time if replaying in real time."""
+        with self.lock:
+            queue = self.queues.get((channel, operation, key))
+            if not queue:
+                raise ReplayMismatch(f'{channel}: no more {operation} records in the recording')
+            t, payload = queue.popleft()
+            if self.start is None:
+                self.start = perf_counter() - t
+        if self.real_time:
+            delay = self.start + t - perf_counter()
+            if delay > 0:
+                sleep(delay)
+        return payload
+
+    def remaining(self):
+        """Return the number of records not yet replayed, for each channel."""
+        counts = defaultdict(int)
+        for (channel, operation, key), queue in self.queues.items():
+            counts[channel] += len(queue)
+        return dict(counts)
+
+    def enable(self):
+        """Start replaying."""
+        if self.patches:
+            return
+        replay = self
+        self.patch(motor_controller.MotorController, 'openPort',
+                   classmethod(lambda cls: ReplaySerial(replay, f'serial:{cls.port_name}')))
+        probe_init = hall_probe.MetrolabProbe.__init__
+        default_name = inspect.signature(probe_init).parameters['resource_name'].default
+
+        def replay_probe_init(probe, resource_name=default_name, resource_manager=None):
+            probe_init(probe, resource_name, ReplayResourceManager(replay) if resource_manager is None else resource_manager)
+        self.patch(hall_probe.MetrolabProbe, '__init__', replay_probe_init)
+        card_init = adlink_card.AdlinkCard.__init__
+        self.patch(adlink_card.AdlinkCard, '__init__',
+                   lambda card, backend=None: card_init(card, ReplayBackend(replay) if backend is None else backend))
+        if not self.real_time:
+            self.patch(motor_controller, 'sleep', lambda seconds: None)
+
+    def close(self):
+        """Stop replaying."""
+        self.disable()
+
+
+if __name__ == '__main__':
+    import argparse
+    from collections import Counter
+    parser = argparse.ArgumentParser(description='Summarise an instrument log.')
+    parser.add_argument('log', help='log file written by Recorder')
+    args = parser.parse_args()
+    records = read_log(args.log)
+    print(f'{len(records)} records over {records[-1][0] if records else 0:.1f} s')
+    for (channel, operation), count in sorted(Counter((r[1], r[2]) for r in records).items()):
+        print(f'{channel:40s} {operation:16s} {count}')
@@ -0,0 +1,170 @@
+"""Opt-in latency tracing of the instrument calls made during scans.
+When enabled, Axis.talk, MetrolabProbe.send/query/trigger and every _8102_* call on the encoder card are timed and
+recorded in a ring buffer, along with a span for each LineScan.run. Nothing is patched until enable() is called,
+so there is no overhead otherwise."""
+import json
+import os
+import threading
+from bisect import bisect_right
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+import motor_controller
+import hall_probe
+import adlink_card
+import hp_line_scan
+
+# histogram bin edges in seconds: four per decade from 10 us to 100 s
+bin_edges = [10 ** (k / 4) for k in range(-20, 9)]
+card_functions = ('_8102_initial', '_8102_config_from_file', '_8102_int_control')  # ones without an axis number
+
+
+class TracedBackend:
+    """Wraps an encoder card backend so that every _8102_* call is recorded by a Tracer."""
+
+    def __init__(self, backend, tracer):
+        self.backend = backend
+        self.tracer = tracer
+
+    def __getattr__(self, name):
+        func = getattr(self.backend, name)
+        if not name.startswith('_8102_'):
+            return func
+        tracer = self.tracer
+
+        @wraps(func)
+        def traced(*args):
+            start = perf_counter()
+            try:
+                return func(*args)
+            finally:
+                axis = None if name in card_functions else args[0]
+                tracer.record('dll', name, axis, start, perf_counter() - start)
+        setattr(self, name, traced)  # cache it, so __getattr__ isn't called again
+        return traced
+
+
+class Tracer:
+    """Records the command, axis and duration of instrument calls in a ring buffer of the given size.
+    If trace_dir is given, a Chrome trace-event file is written there at the end of each scan."""
+
+    def __init__(self, size=100000, trace_dir=None):
+        self.events = deque(maxlen=size)  # (category, name, axis, thread id, start, duration)
+        self.trace_dir = trace_dir
+        if trace_dir:
+            os.makedirs(trace_dir, exist_ok=True)
+        self.patches = []  # (owner, attribute name, original)
+        self.scan_count = 0
+        self.t0 = perf_counter()
+
+    def record(self, category, name, axis, start, duration):
+        self.events.append((category, name, axis, threading.get_ident(), start, duration))
+
+    def patch(self, owner, attribute, describe, category):
+        """Replace a method of a class with a traced version. describe(self, *args) returns (name, axis)."""
+        method = getattr(owner, attribute)
+        record = self.record
+
+        @wraps(method)
+        def traced(obj, *args, **kwargs):
+            start = perf_counter()
+            try:
+                return method(obj, *args, **kwargs)
+            finally:
+                record(category, *describe(obj, *args), start, perf_counter() - start)
+        setattr(owner, attribute, traced)
+        self.patches.append((owner, attribute, method))
+
+    def enable(self):
+        """Start tracing."""
+        if self.patches:
+            return
+        probe_command = lambda probe, message: (message.split(' ')[0].rstrip(';'), 'probe')
+        self.patch(motor_controller.Axis, 'talk', lambda axis, command, *args: (command.upper(), axis.id), 'serial')
+        self.patch(hall_probe.MetrolabProbe, 'send', probe_command, 'visa')
+        self.patch(hall_probe.MetrolabProbe, 'query', probe_command, 'visa')
+        self.patch(hall_probe.MetrolabProbe, 'trigger', lambda probe: ('*TRG', 'probe'), 'visa')
+        card_init = adlink_card.AdlinkCard.__init__
+        tracer = self
+
+        @wraps(card_init)
+        def traced_card_init(card, backend=None):  # wrap the backend first, so the set-up calls are traced too
+            card_init(card, TracedBackend(adlink_card.DllBackend() if backend is None else backend, tracer))
+        adlink_card.AdlinkCard.__init__ = traced_card_init
+        self.patches.append((adlink_card.AdlinkCard, '__init__', card_init))
+        run = hp_line_scan.LineScan.run
+
+        @wraps(run)
+        def traced_run(line_scan, *args, **kwargs):
+            with tracer.scan(f'line {line_scan.axis_name}'):
+                return run(line_scan, *args, **kwargs)
+        hp_line_scan.LineScan.run = traced_run
+        self.patches.append((hp_line_scan.LineScan, 'run', run))
+
+    def disable(self):
+        """Stop tracing, and restore the original methods."""
+        for owner, attribute, original in reversed(self.patches):
+            setattr(owner, attribute, original)
+        self.patches = []
+
+    def instrumentCard(self, card):
+        """Trace the DLL calls of an encoder card created before tracing was enabled."""
+        if not isinstance(card.dll, TracedBackend):
+            card.dll = TracedBackend(card.dll, self)
+            for axis in card.axis.values():
+                axis.dll = card.dll
+
+    @contextmanager
+    def scan(self, label):
+        """Record a span covering a scan, and write a trace file for it if required."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            stop = perf_counter()
+            self.record('scan', label, None, start, stop - start)
+            self.scan_count += 1
+            if self.trace_dir:
+                path = os.path.join(self.trace_dir, f'{self.scan_count:04d} {label}.json')
+                self.writeChromeTrace(path, start, stop)
+
+    def select(self, start=None, stop=None):
+        """Return the events starting between the given times."""
+        return [event for event in list(self.events)
+                if (start is None or event[4] >= start) and (stop is None or event[4] <= stop)]
+
+    def histograms(self, start=None, stop=None):
+        """Return a dict of statistics and a histogram of durations for each command, keyed by 'category name'."""
+        durations = defaultdict(list)
+        for category, name, axis, thread, t, duration in self.select(start, stop):
+            durations[f'{category} {name}'].append(duration)
+        stats = {}
+        for command, values in sorted(durations.items()):
+            counts = [0] * (len(bin_edges) + 1)
+            for value in values:
+                counts[bisect_right(bin_edges, value)] += 1
+            labels = [f'<{edge:.3g}' for edge in bin_edges] + [f'>={bin_edges[-1]:.3g}']
+            stats[command] = {'count': len(values), 'total': sum(values), 'mean': sum(values) / len(values),
+                              'max': max(values), 'histogram': {l: n for l, n in zip(labels, counts) if n}}
+        return stats
+
+    def summary(self, start=None, stop=None):
+        """Return a table of the time taken by each command, most expensive first."""
+        stats = self.histograms(start, stop)
+        lines = [f'{"command":<36}{"count":>8}{"total [s]":>12}{"mean [ms]":>12}{"max [ms]":>12}']
+        for command, s in sorted(stats.items(), key=lambda item: -item[1]['total']):
+            lines.append(f'{command:<36}{s["count"]:>8}{s["total"]:>12.3f}{s["mean"] * 1e3:>12.2f}{s["max"] * 1e3:>12.2f}')
+        return '\n'.join(lines)
+
+    def chromeTrace(self, start=None, stop=None):
+        """Return the events as a Chrome trace-event dict (load the JSON in chrome://tracing or Perfetto)."""
+        pid = os.getpid()
+        trace_events = [{'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': thread,
+                         'ts': (t - self.t0) * 1e6, 'dur': duration * 1e6, 'args': {'axis': axis}}
+                        for category, name, axis, thread, t, duration in self.select(start, stop)]
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+    def writeChromeTrace(self, path, start=None, stop=None):
+        with open(path, 'w') as trace_file:
+            json.dump(self.chromeTrace(start, stop), trace_file)
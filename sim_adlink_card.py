@@ -0,0 +1,185 @@
+"""Simulated ADLINK PCI-8102 encoder card, with encoder counters following simulated motor axes."""
+import random
+from functools import wraps
+from time import monotonic, sleep
+import adlink_card
+from adlink_card import CheckSuccess, CompareMethod
+
+
+def checked(func):
+    """Check the return code of a simulated DLL function in the same way as the real ones."""
+    @wraps(func)
+    def wrapper(*args):
+        return CheckSuccess(func(*args), func, args[1:])
+    return wrapper
+
+
+class SimulatedEncoder:
+    """Encoder counter for one axis of the card. The count is offset + ratio * (steps of the linked motor axis)."""
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.link = None  # sim_motor_controller.SimulatedAxis
+        self.ratio = 1.0
+        self.offset = 0.0
+        self.int_factor = 0
+        self.comparator = None  # (method, data)
+        self.missed = False
+
+    def count(self):
+        return self.offset + (0.0 if self.link is None else self.ratio * self.link.position())
+
+    def conditionMet(self, previous, now):
+        """Check the trigger comparator, given the count at the previous check and now."""
+        method, data = self.comparator
+        if method == CompareMethod.DATA_GT_SOURCE_COUNTER:
+            return data > now
+        if method == CompareMethod.DATA_LT_SOURCE_COUNTER:
+            return data < now
+        crossed = min(previous, now) <= data <= max(previous, now) and previous != now
+        if method == CompareMethod.DATA_EQ_SOURCE_COUNTER_COUNT_UP_ONLY:
+            return crossed and now > previous
+        if method == CompareMethod.DATA_EQ_SOURCE_COUNTER_COUNT_DOWN_ONLY:
+            return crossed and now < previous
+        return crossed or now == data
+
+
+class SimulatedBackend:
+    """Pure-Python stand-in for the 8102 DLL, returning the same error codes.
+    Set miss_probability to make the trigger events of some comparator settings go missing at random, so that waits
+    for them time out as on a misbehaving card."""
+
+    def __init__(self, n_axes=2, miss_probability=0.0, poll_interval=0.0005, seed=None, clock=monotonic):
+        self.encoders = [SimulatedEncoder(clock) for _ in range(n_axes)]
+        self.miss_probability = miss_probability
+        self.poll_interval = poll_interval  # how often the simulated comparator is checked, seconds
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.initialised = False
+        self.int_enabled = False
+
+    def link(self, axis_no, motor_axis, ratio=1.0):
+        """Make the encoder counter follow a simulated motor axis, keeping the current count."""
+        encoder = self.encoders[axis_no]
+        count = encoder.count()
+        encoder.link = motor_axis
+        encoder.ratio = ratio
+        encoder.offset = count - ratio * motor_axis.position()
+
+    def encoder(self, axis_no):
+        """Return (error code, encoder) for the given axis number."""
+        if not self.initialised:
+            return -10211, None  # card not initial
+        if not 0 <= axis_no < len(self.encoders):
+            return -10216, None  # axis range error
+        return 0, self.encoders[axis_no]
+
+    @checked
+    def _8102_initial(self, card_id, manual_id):
+        if self.initialised:
+            return -10200  # other process exist
+        self.initialised = True
+        if hasattr(card_id, 'value'):
+            card_id.value = 1  # one card, in bit 0
+        return 0
+
+    @checked
+    def _8102_config_from_file(self):
+        return 0 if self.initialised else -10211
+
+    @checked
+    def _8102_int_control(self, card_no, enable):
+        if not self.initialised:
+            return -10211
+        if card_no != 0:
+            return -10000  # card number
+        self.int_enabled = bool(enable)
+        return 0
+
+    @checked
+    def _8102_set_position(self, axis_no, position):
+        error, encoder = self.encoder(axis_no)
+        if not error:
+            encoder.offset += position - encoder.count()
+        return error
+
+    @checked
+    def _8102_get_position(self, axis_no, position):
+        error, encoder = self.encoder(axis_no)
+        if not error:
+            position.value = encoder.count()
+        return error
+
+    @checked
+    def _8102_set_motion_int_factor(self, axis_no, int_factor):
+        error, encoder = self.encoder(axis_no)
+        if not error:
+            encoder.int_factor = int(int_factor)
+        return error
+
+    @checked
+    def _8102_set_trigger_comparator(self, axis_no, source, method, data):
+        error, encoder = self.encoder(axis_no)
+        if error:
+            return error
+        if source not in adlink_card.ComparingSource.__members__.values():
+            return -10217  # compare parameter error
+        if method not in CompareMethod.__members__.values():
+            return -10218  # compare method
+        encoder.comparator = (CompareMethod(method), data)
+        encoder.missed = self.random.random() < self.miss_probability  # this trigger event will never come
+        return 0
+
+    @checked
+    def _8102_wait_motion_interrupt(self, axis_no, int_factor_bit, timeout):
+        error, encoder = self.encoder(axis_no)
+        if error:
+            return error
+        if not self.int_enabled or not encoder.int_factor & (1 << int_factor_bit) or encoder.comparator is None:
+            return -10207  # event not enable yet
+        give_up = self.clock() + timeout / 1000
+        previous = encoder.count()
+        while True:
+            now = encoder.count()
+            if not encoder.missed and encoder.conditionMet(previous, now):
+                return 0
+            if self.clock() > give_up:
+                return -10220  # axis INT wait failed
+            previous = now
+            sleep(self.poll_interval)
+
+
+class SimulatedCardAxis(adlink_card.Axis):
+    """Card axis whose counter can be switched to a different simulated motor axis, as line scans along x use the
+    counter 'z' on the rig."""
+
+    def follow(self, motor_axis):
+        """Link the counter to a motor axis on a simulated serial port (anything else is left alone)."""
+        sim_axes = getattr(getattr(motor_axis, 'serial_port', None), 'axes', {})
+        if motor_axis.id in sim_axes:
+            self.dll.link(self.id, sim_axes[motor_axis.id])
+
+
+class SimulatedAdlinkCard(adlink_card.AdlinkCard):
+    """AdlinkCard using the simulated backend. Each card axis named in links follows the named axis of the
+    (simulated) motor controller mc, until it is made to follow another. Other arguments are passed to
+    SimulatedBackend."""
+
+    def __init__(self, mc=None, links=None, **kwargs):
+        super().__init__(backend=SimulatedBackend(**kwargs))
+        self.axis = {name: SimulatedCardAxis(self.dll, axis.id, axis.card_id) for name, axis in self.axis.items()}
+        if mc is not None:
+            for card_axis, motor_axis in (links or {'z': 'z', 'x': 'x'}).items():
+                self.dll.link(self.axis[card_axis].id, mc.serial_port.axes[mc.axis[motor_axis].id])
+
+
+if __name__ == '__main__':
+    import sim_motor_controller
+    mc = sim_motor_controller.SimulatedMotorController()
+    card = SimulatedAdlinkCard(mc)
+    axis, enc_axis = mc.axis['z'], card.axis['z']
+    enc_axis.setPosition(axis.get_position(set_value=False) * axis.scale_factor)
+    axis.move(5.1)  # go a little further so the last trigger fires
+    for z in range(1, 6):
+        enc_axis.waitForPosition(z * axis.scale_factor)
+        print('Triggered at', enc_axis.getPosition())
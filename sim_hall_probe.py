@@ -0,0 +1,232 @@
+"""Simulated Metrolab Hall probe, taking its readings from an analytic magnet model at the position of a simulated stage."""
+import enum
+import random
+from math import sqrt, tanh, cosh
+from time import monotonic, sleep
+import hall_probe
+
+
+class StatusCode(enum.IntEnum):
+    """The bit of pyvisa's StatusCode that MetrolabProbe looks at."""
+    success = 0
+
+
+class SolenoidField:
+    """Field of a finite solenoid along z, using the paraxial approximation off axis. Lengths in mm, field in T."""
+
+    def __init__(self, b0=0.1, length=100.0, radius=30.0, centre=(0.0, 0.0, 0.0)):
+        self.b0 = b0  # field at the centre of an infinitely long solenoid
+        self.length = length
+        self.radius = radius
+        self.centre = centre
+
+    def onAxis(self, z):
+        """Return (Bz, dBz/dz) on the axis."""
+        a = z + self.length / 2
+        b = z - self.length / 2
+        r2 = self.radius ** 2
+        bz = self.b0 / 2 * (a / sqrt(a ** 2 + r2) - b / sqrt(b ** 2 + r2))
+        dbz = self.b0 / 2 * (r2 / (a ** 2 + r2) ** 1.5 - r2 / (b ** 2 + r2) ** 1.5)
+        return bz, dbz
+
+    def __call__(self, x, y, z):
+        x, y, z = x - self.centre[0], y - self.centre[1], z - self.centre[2]
+        bz, dbz = self.onAxis(z)
+        # Br = -r/2 dBz/dz, so Bx = -x/2 dBz/dz etc.
+        return -x / 2 * dbz, -y / 2 * dbz, bz
+
+
+class DipoleField:
+    """Field of a dipole with a uniform vertical (y) field inside and tanh fringe fields at each end along z.
+    Lengths in mm, field in T."""
+
+    def __init__(self, b0=1.0, length=200.0, fringe_length=20.0, gradient=0.0, centre=(0.0, 0.0, 0.0)):
+        self.b0 = b0
+        self.length = length
+        self.fringe_length = fringe_length
+        self.gradient = gradient  # T/mm across x, for a combined-function magnet
+        self.centre = centre
+
+    def __call__(self, x, y, z):
+        x, y, z = x - self.centre[0], y - self.centre[1], z - self.centre[2]
+        g = self.fringe_length
+        a = (z + self.length / 2) / g
+        b = (z - self.length / 2) / g
+        profile = (tanh(a) - tanh(b)) / 2
+        dprofile = (1 / cosh(a) ** 2 - 1 / cosh(b) ** 2) / (2 * g)
+        by = (self.b0 + self.gradient * x) * profile
+        bz = (self.b0 + self.gradient * x) * y * dprofile  # from curl B = 0 to first order in y
+        return self.gradient * y * profile, by, bz
+
+
+def stage_position(mc, offset=(0.0, 0.0, 0.0)):
+    """Return a function giving the (x, y, z) position in mm of a probe on the stage of a simulated motor controller,
+    read directly from the simulation rather than over the serial port. Probes can be mounted at an offset."""
+    axes = [(mc.serial_port.axes[mc.axis[name].id], mc.axis[name].scale_factor) for name in ('x', 'y', 'z')]
+    return lambda: tuple(sim_axis.position() / scale + d for (sim_axis, scale), d in zip(axes, offset))
+
+
+class SimulatedProbeResource:
+    """Stand-in for the VISA resource of a Metrolab THM1176, implementing the SCPI subset used by MetrolabProbe.
+    Each reading takes (averages / sample_rate) seconds; auto-ranging adds a delay each time the range changes."""
+    manufacturer_name = 'Metrolab Technology SA'
+    model_name = 'THM1176 (simulated)'
+    ranges = (0.1, 0.5, 3.0, 20.0)
+    units = {'T': 1000000, 'MT': 1000, 'UT': 1, 'NT': 0.001, 'GAUSS': 100, 'KGAUSS': 100000, 'MGAUSS': 0.1}
+
+    def __init__(self, field_model=None, position_source=None, sample_rate=3000.0, noise=1e-4, latency=0.002,
+                 range_switch_time=0.05, serial_number='0000155', seed=None, clock=monotonic):
+        self.field_model = field_model or SolenoidField()
+        self.position_source = position_source or (lambda: (0.0, 0.0, 0.0))
+        self.sample_rate = sample_rate  # raw samples per second; each reading averages a number of these
+        self.noise = noise  # RMS noise of a single sample, as a fraction of the range
+        self.latency = latency  # USB round trip, seconds
+        self.range_switch_time = range_switch_time
+        self.serial_number = serial_number
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.timeout = 2000
+        self.read_termination = '\n'
+        self.unit = 'T'
+        self.averages = 1
+        self.range = self.ranges[0]
+        self.auto_range = True
+        self.trigger_source = hall_probe.TriggerSource.IMMEDIATE
+        self.trigger_count = 1
+        self.armed = 0  # triggers still expected
+        self.readings = []  # list of (time ready, (Bx, By, Bz) in T)
+        self.busy_until = clock()
+        self.range_switches = 0
+
+    def close(self):
+        pass
+
+    def reading(self, position):
+        """Return a single reading at the given position, and how long it took."""
+        field = self.field_model(*position)
+        duration = self.averages / self.sample_rate
+        if self.auto_range:
+            peak = max(abs(b) for b in field)
+            new_range = next((r for r in self.ranges if peak < r), self.ranges[-1])
+            if new_range != self.range:
+                self.range = new_range
+                self.range_switches += 1
+                duration += self.range_switch_time
+        sigma = self.noise * self.range / sqrt(self.averages)
+        field = tuple(max(-self.range, min(self.range, b + self.random.gauss(0, sigma))) for b in field)
+        return field, duration
+
+    def measure(self):
+        """Start a reading now (or when the previous one finishes) at the current stage position."""
+        field, duration = self.reading(self.position_source())
+        self.busy_until = max(self.busy_until, self.clock()) + duration
+        self.readings.append((self.busy_until, field))
+
+    def wait(self, until):
+        delay = until - self.clock()
+        if delay > 0:
+            sleep(delay)
+
+    def format(self, values, digits):
+        scale = 1e6 / self.units[self.unit]
+        return ','.join(f'{v * scale:.{digits}g}' for v in values)
+
+    def assert_trigger(self):
+        sleep(self.latency)
+        if self.armed and self.trigger_source == hall_probe.TriggerSource.BUS:
+            self.armed -= 1
+            self.measure()
+
+    def write(self, message):
+        sleep(self.latency)
+        self.command(message)
+        return len(message), StatusCode.success
+
+    def query(self, message):
+        sleep(self.latency)
+        return self.command(message)
+
+    def command(self, message):
+        """Interpret a SCPI command, returning the reply for queries."""
+        message = message.strip().rstrip(';')
+        header, _, argument = message.partition(' ')
+        header = header.upper()
+        argument = argument.strip()
+        replies = {':SENS:ALL?': lambda: ','.join(f'{r:g} T' for r in self.ranges),
+                   ':SENS?': lambda: f'{self.range:f} T',
+                   ':SENS:AUTO?': lambda: hall_probe.OnState(self.auto_range).name,
+                   ':UNIT:ALL?': lambda: ','.join(f'{name},{value:g}' for name, value in self.units.items()),
+                   ':UNIT?': lambda: self.unit,
+                   ':AVER:COUN?': lambda: str(self.averages)}
+        if header in replies:
+            return replies[header]()
+        if header == ':SENS:AUTO':
+            self.auto_range = hall_probe.OnState[argument.upper()].value
+        elif header == ':SENS':
+            self.range = next(r for r in self.ranges if float(argument) <= r)
+        elif header == ':UNIT':
+            self.unit = argument.upper()
+        elif header == ':AVER:COUN':
+            self.averages = int(argument)
+        elif header == ':ABOR':
+            self.armed = 0
+        elif header == ':TRIG:SOUR':
+            self.trigger_source = hall_probe.TriggerSource(argument.upper())
+        elif header == ':TRIG:COUN':
+            self.trigger_count = int(argument)
+        elif header == ':INIT':
+            self.readings = []
+            self.armed = self.trigger_count
+            if self.trigger_source != hall_probe.TriggerSource.BUS:  # timer triggering treated as immediate
+                for _ in range(self.trigger_count):
+                    self.measure()
+                self.armed = 0
+        elif header.startswith(':READ:ARR:') or header.startswith(':FETC:ARR:'):
+            component = 'XYZ'.index(header[-2])
+            count, *_, digits = argument.split(',')
+            count, digits = int(count), int(digits)
+            if header.startswith(':READ'):  # fresh set of readings
+                self.readings = []
+                for _ in range(count):
+                    self.measure()
+            if len(self.readings) < count:
+                raise TimeoutError(f'VI_ERROR_TMO: only {len(self.readings)} of {count} readings available')
+            ready, fields = zip(*self.readings[:count])
+            self.wait(max(ready))
+            return self.format([field[component] for field in fields], digits)
+        else:
+            raise ValueError(f'simulated probe does not understand "{message}"')
+
+
+class SimulatedResourceManager:
+    """Stand-in for visa.ResourceManager, handing out simulated probes."""
+
+    def __init__(self, resources):
+        self.resources = resources  # dict of resource name: resource
+
+    def list_resources(self):
+        return tuple(self.resources)
+
+    def open_resource(self, resource_name, read_termination='\n', **kwargs):
+        resource = self.resources[resource_name]
+        resource.read_termination = read_termination
+        return resource
+
+
+class SimulatedMetrolabProbe(hall_probe.MetrolabProbe):
+    """MetrolabProbe reading from a simulated resource. Other arguments are passed to SimulatedProbeResource."""
+
+    def __init__(self, field_model=None, position_source=None, resource_name='SIM::PROBE::INSTR', **kwargs):
+        resource = SimulatedProbeResource(field_model, position_source, **kwargs)
+        super().__init__(resource_name, SimulatedResourceManager({resource_name: resource}))
+
+
+if __name__ == '__main__':
+    import sim_motor_controller
+    mc = sim_motor_controller.SimulatedMotorController()
+    hp = SimulatedMetrolabProbe(SolenoidField(), stage_position(mc))
+    hp.setAverages(100)
+    print('Ranges:', hp.ranges, hp.range_units, 'range:', hp.getRange())
+    for z in (-60, 0, 60):
+        mc.serial_port.axes[mc.axis['z'].id].setPosition(z * mc.axis['z'].scale_factor)
+        print(z, hp.getField())
@@ -0,0 +1,260 @@
+"""Simulated McLennan / SCL motor controllers, for running scan code without the rig."""
+import re
+from math import copysign, sqrt
+from time import monotonic
+import motor_controller
+
+command_format = re.compile(r'^(\d+)([A-Z]{2})(.*)$')
+
+
+class TrapezoidalMove:
+    """Position profile for a move with constant acceleration up to (at most) a slew speed, then deceleration.
+    Positions in steps, times in seconds."""
+
+    def __init__(self, start, end, speed, acceleration, start_time, start_speed=0.0):
+        self.start = start
+        self.end = end
+        self.start_time = start_time
+        self.direction = copysign(1, end - start)
+        distance = abs(end - start)
+        self.acceleration = acceleration
+        v0 = min(max(start_speed, 0.0), sqrt(2 * acceleration * distance))  # can't go faster than we can stop
+        peak = sqrt((2 * acceleration * distance + v0 ** 2) / 2)  # triangular profile
+        self.peak_speed = max(min(speed, peak), v0)
+        self.start_speed = v0
+        self.t_accel = (self.peak_speed - v0) / acceleration
+        self.d_accel = (self.peak_speed ** 2 - v0 ** 2) / (2 * acceleration)
+        self.t_decel = self.peak_speed / acceleration
+        self.d_decel = self.peak_speed ** 2 / (2 * acceleration)
+        d_cruise = max(distance - self.d_accel - self.d_decel, 0.0)
+        self.t_cruise = d_cruise / self.peak_speed if self.peak_speed > 0 else 0.0
+        self.duration = self.t_accel + self.t_cruise + self.t_decel
+
+    def state(self, t):
+        """Return (position, velocity) at time t."""
+        t = t - self.start_time
+        a = self.acceleration
+        if t <= 0:
+            return self.start, self.direction * self.start_speed
+        if t >= self.duration:
+            return self.end, 0.0
+        if t < self.t_accel:
+            dist = self.start_speed * t + a * t ** 2 / 2
+            speed = self.start_speed + a * t
+        elif t < self.t_accel + self.t_cruise:
+            dist = self.d_accel + self.peak_speed * (t - self.t_accel)
+            speed = self.peak_speed
+        else:
+            t_left = self.duration - t
+            dist = abs(self.end - self.start) - a * t_left ** 2 / 2
+            speed = a * t_left
+        return self.start + self.direction * dist, self.direction * speed
+
+    def finished(self, t):
+        return t - self.start_time >= self.duration
+
+
+class SimulatedAxis:
+    """State of one axis on a simulated controller. Positions, speeds and limits are in steps."""
+
+    def __init__(self, axis_id, version='PM341', speed=4000, acceleration=1000, position=0, clock=monotonic):
+        self.id = axis_id
+        self.version = version
+        self.speed = speed  # slew speed, steps/s
+        self.acceleration = acceleration  # steps/s/s
+        self.clock = clock
+        self.limits_enabled = version == 'PM600'  # a PM600 always enforces its limits
+        self.lower_limit = -9999999
+        self.upper_limit = 9999999
+        self.profile = TrapezoidalMove(position, position, speed, acceleration, clock())
+        if version == 'PM304':
+            self.prefix = ''
+        elif version == 'SCL':
+            self.prefix = str(axis_id)
+        else:
+            self.prefix = '{:02d}{}'.format(axis_id, '#' if version == 'PM341' else ':')
+
+    @classmethod
+    def fromAxis(cls, axis, clock=monotonic):
+        """Create a simulated axis matching the parameters of a motor_controller.Axis."""
+        scale = abs(axis.scale_factor)
+        return cls(axis.id, axis.version, axis.max_speed * scale, axis.acceleration * scale, clock=clock)
+
+    def position(self):
+        """Return the current position in steps."""
+        return self.profile.state(self.clock())[0]
+
+    def velocity(self):
+        """Return the current velocity in steps/s."""
+        return self.profile.state(self.clock())[1]
+
+    def moving(self):
+        return not self.profile.finished(self.clock())
+
+    def moveTo(self, target):
+        """Start a move to the given position. Return False if it is outside the soft limits."""
+        if self.limits_enabled and not self.lower_limit <= target <= self.upper_limit:
+            return False
+        now = self.clock()
+        position, velocity = self.profile.state(now)
+        # carry on at the current speed if we are already going the right way
+        start_speed = abs(velocity) if velocity * (target - position) > 0 else 0.0
+        self.profile = TrapezoidalMove(position, target, self.speed, self.acceleration, now, start_speed)
+        return True
+
+    def stop(self):
+        """Decelerate to a halt."""
+        now = self.clock()
+        position, velocity = self.profile.state(now)
+        stop_at = position + copysign(velocity ** 2 / (2 * self.acceleration), velocity)
+        self.profile = TrapezoidalMove(position, stop_at, self.speed, self.acceleration, now, abs(velocity))
+
+    def setPosition(self, position):
+        """Redefine the current position without moving."""
+        self.profile = TrapezoidalMove(position, position, self.speed, self.acceleration, self.clock())
+
+    def queryAll(self):
+        """Return the lines of a 'qa' reply, in the same layout the controllers use."""
+        position = round(self.position())
+        limits = 'Enabled' if self.limits_enabled else 'Disabled'
+        return [f'{self.prefix}Mclennan {self.version} simulated controller',
+                f'Mode = {"Moving" if self.moving() else "Idle"}          Display = Command',
+                f'Slew speed = {round(self.speed)}          Acceleration = {round(self.acceleration)}',
+                f'Lower limit = {self.lower_limit}          Upper limit = {self.upper_limit}',
+                f'Soft limits = {limits}          Tracking = 1000',
+                f'Command pos = {position}          Actual pos = {position}']
+
+    def respond(self, command, parameter):
+        """Act on a command and return the reply lines (without line endings)."""
+        ok = self.prefix + ('%' if self.version == 'SCL' else 'OK')
+        try:
+            value = int(parameter) if parameter else 0
+        except ValueError:
+            return [self.prefix + ('?' if self.version == 'SCL' else '!BAD PARAMETER')]
+        position = round(self.position())
+        if self.version == 'SCL':
+            replies = {'IE': lambda: [f'{self.prefix}IE={position}'],
+                       'FP': lambda: [ok] if self.moveTo(value) else [self.prefix + '?'],
+                       'FL': lambda: [ok] if self.moveTo(position + value) else [self.prefix + '?'],
+                       'ST': lambda: self.stop() or [ok]}
+        else:
+            replies = {'OC': lambda: [('CP=' if self.version == 'PM304' else self.prefix) + str(position)],
+                       'OA': lambda: [('AP=' if self.version == 'PM304' else self.prefix) + str(position)],
+                       'MA': lambda: [ok] if self.moveTo(value) else [self.prefix + '!SOFT LIMIT'],
+                       'MR': lambda: [ok] if self.moveTo(position + value) else [self.prefix + '!SOFT LIMIT'],
+                       'ST': lambda: self.stop() or [ok],
+                       'CP': lambda: self.setPosition(value) or [ok],
+                       'AP': lambda: self.setPosition(value) or [ok],
+                       'SV': lambda: setattr(self, 'speed', abs(value)) or [ok],
+                       'IL': lambda: setattr(self, 'limits_enabled', False) or [ok],
+                       'AL': lambda: setattr(self, 'limits_enabled', True) or [ok],
+                       'LL': lambda: setattr(self, 'lower_limit', value) or [ok],
+                       'UL': lambda: setattr(self, 'upper_limit', value) or [ok],
+                       'QA': self.queryAll}
+            if self.version == 'PM600':  # limits can't be turned off, so there are no commands to do it
+                del replies['IL'], replies['AL']
+        try:
+            return replies[command]()
+        except KeyError:
+            return [self.prefix + ('?' if self.version == 'SCL' else '!UNKNOWN COMMAND')]
+
+
+class SimulatedSerial:
+    """Stand-in for serial.Serial: addressed commands are answered by the simulated axes after a reply latency."""
+
+    def __init__(self, axes=(), latency=0.02, clock=monotonic):
+        self.port = None
+        self.bytesize = 8
+        self.parity = 'N'
+        self.is_open = False
+        self.latency = latency  # seconds between receiving a command and the reply being available
+        self.clock = clock
+        self.axes = {axis.id: axis for axis in axes}
+        self.write_count = 0  # number of commands received, i.e. round trips
+        self._input = b''
+        self._pending = []  # list of (time available, bytes)
+
+    def addAxis(self, axis):
+        self.axes[axis.id] = axis
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def write(self, data):
+        """Receive one or more commands terminated by CR or CRLF."""
+        self._input += data
+        while b'\r' in self._input:
+            line, self._input = self._input.split(b'\r', maxsplit=1)
+            self._input = self._input[1:] if self._input.startswith(b'\n') else self._input
+            self._receive(line.decode('utf-8'))
+        return len(data)
+
+    def _receive(self, line):
+        self.write_count += 1
+        match = command_format.match(line)
+        axis = self.axes.get(int(match.group(1))) if match else None
+        if axis is None:  # nobody on the chain answers
+            return
+        line_end = '\r' if axis.version == 'SCL' else '\r\n'
+        reply = axis.respond(match.group(2), match.group(3))
+        if axis.version != 'SCL':
+            reply.insert(0, line)  # echo
+        self._pending.append((self.clock() + self.latency, ''.join(r + line_end for r in reply).encode('utf-8')))
+
+    @property
+    def in_waiting(self):
+        now = self.clock()
+        return sum(len(data) for t, data in self._pending if t <= now)
+
+    def read_all(self):
+        now = self.clock()
+        ready = [data for t, data in self._pending if t <= now]
+        self._pending = [(t, data) for t, data in self._pending if t > now]
+        return b''.join(ready)
+
+    def read(self, size=1):
+        data = self.read_all()
+        if len(data) > size:
+            self._pending.insert(0, (self.clock(), data[size:]))
+        return data[:size]
+
+
+def add_simulated_axes(controller, clock=monotonic):
+    """Populate a simulated port with axes matching those set up by the controller using it."""
+    axes = controller.axis.values() if isinstance(controller.axis, dict) else [controller.axis]
+    for axis in axes:
+        controller.serial_port.addAxis(SimulatedAxis.fromAxis(axis, clock=clock))
+
+
+class SimulatedMotorController(motor_controller.MotorController):
+    """MotorController talking to a simulated chain of controllers. Give a dict of {axis name: (lower, upper)} to
+    set soft limits in mm, so that moves beyond them fail as they would on the rig."""
+
+    def __init__(self, latency=0.02, clock=monotonic, limits=None):
+        port = SimulatedSerial(latency=latency, clock=clock)
+        port.open()
+        super().__init__(serial_port=port)
+        add_simulated_axes(self, clock)
+        for axis_name, axis_limits in (limits or {}).items():
+            self.axis[axis_name].setLimits(axis_limits)
+
+
+class SimulatedZeptoDipoleController(motor_controller.ZeptoDipoleController):
+    """ZeptoDipoleController talking to a simulated SCL drive."""
+
+    def __init__(self, latency=0.02, clock=monotonic):
+        port = SimulatedSerial(latency=latency, clock=clock)
+        port.open()
+        super().__init__(serial_port=port)
+        add_simulated_axes(self, clock)
+
+
+if __name__ == '__main__':
+    mc = SimulatedMotorController()
+    axis = mc.axis['x']
+    print('limits:', axis.getLimits(), 'speed:', axis.getSpeed())
+    axis.move(1, wait=True, tolerance=0.001)
+    print('position:', axis.get_position(set_value=False))
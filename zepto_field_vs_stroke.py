@@ -1,21 +1,30 @@
-import motor_controller
-import hall_probe
-import numpy as np
+"""Measure the field of the ZEPTO dipole as a function of the stroke of its moving magnets.
+Run from the command line with "magnet_lab.py stroke"; running this script uses the settings below."""
+import instrument_session
+import hp_line_scan
 
-dipole_ctrl = motor_controller.ZeptoDipoleController()
-dipole_axis = dipole_ctrl.axis
-probe = hall_probe.MetrolabProbe()
-probe.setAverages(100)
 
-filename = r'\\fed.cclrc.ac.uk\Org\NLab\ASTeC\Apsv4\Astec\IDs and Magnets\Data\ZEPTO dipole\01 field vs stroke.csv'
-file = open(filename, 'a')
+def stroke_scan(start=0, stop=400, step=0.5, session=None, hp_avgs=100, hp_range=None, software_on_the_fly=True,
+                **kwargs):
+    """Run an on-the-fly scan along the stroke axis, using the controller position readings to place the probe
+    triggers (or point by point, if software_on_the_fly is False). Other arguments are passed to LineScan.
+    Return the line scan."""
+    session = instrument_session.InstrumentSession() if session is None else session
+    line_scan = hp_line_scan.LineScan('s', start, stop, step, hp_avgs=hp_avgs, hp_range=hp_range, session=session,
+                                      software_on_the_fly=software_on_the_fly, **kwargs)
+    line_scan.run()
+    return line_scan
 
-# dipole_axis.stop()
-for stroke in np.arange(0, 400.5, 0.5):
-    dipole_axis.move(stroke, wait=True, timeout=1000)
-    field = probe.getField()
-    print(stroke, field)
-    file.writelines(f'{stroke:.1f},' + ','.join(['{:.5f}'.format(b) for b in field[0]]) + '\n')
-    file.flush()
 
-file.close()
+def write_stroke(file, line_scan):
+    """Write stroke,Bx,By,Bz rows to a file."""
+    for stroke, field in zip(line_scan.pos_values, line_scan.field_values):
+        file.writelines(f'{stroke:.1f},' + ','.join(['{:.5f}'.format(b) for b in field]) + '\n')
+
+
+if __name__ == '__main__':
+    filename = r'\\fed.cclrc.ac.uk\Org\NLab\ASTeC\Apsv4\Astec\IDs and Magnets\Data\ZEPTO dipole\01 field vs stroke.csv'
+    # session.zepto.axis.stop()
+    scan = stroke_scan()
+    with open(filename, 'a') as file:
+        write_stroke(file, scan)